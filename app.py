@@ -6,25 +6,37 @@ modified: YujiePan
 """
 
 import asyncio
-import json
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlencode
 
 import aiohttp
 import aiohttp_jinja2 as aiojinja2
-import ansi2html
 import jinja2
 from aiohttp import web
 
 import config as cfg
+from broadcast import MODES, Broadcaster
 from context import Context
-from utils import msg_from_host, now_time
-from workers import (LocalDBWorker, LocalDiskWorker, RemoteGPUWorker,
-                     RemoteNetworkWorker)
-
-scheme = 'solarized'
-ansi2html.style.SCHEME[scheme] = list(ansi2html.style.SCHEME[scheme])
-ansi2html.style.SCHEME[scheme][0] = '#555555'
-ansi_conv = ansi2html.Ansi2HTMLConverter(dark_bg=True, scheme=scheme)
-context = Context()
+from db import Database
+from metrics import registry
+from render import ENCODINGS, Renderer, View
+from timeseries import MetricStore, downsample
+from utils import msg_from_host
+from workers import (LocalCompactionWorker, LocalDBWorker, LocalDiskWorker, LocalHistoryWorker,
+                     PollScheduler, RemoteGPUWorker, RemoteNetworkWorker, SSHConnectionPool)
+
+history = MetricStore(path=cfg.HISTORY_PATH, retention=cfg.HISTORY_RETENTION_DAYS * 86400)
+context = Context(timeseries_tiers=cfg.TIMESERIES_TIERS, history=history)
+render_executor = (ProcessPoolExecutor if cfg.RENDER_POOL == 'process' else ThreadPoolExecutor)(cfg.RENDER_WORKERS)
+renderer = Renderer(context, hosts=cfg.REMOTE_HOST, executor=render_executor, free_memory=cfg.FREE_GPU_MEMORY,
+                    checked_interval=cfg.CHECKED_PUSH_INTERVAL)
+ssh_pool = SSHConnectionPool(max_channels=cfg.SSH_MAX_CHANNELS, max_in_flight=cfg.SSH_MAX_IN_FLIGHT,
+                               connect_timeout=cfg.SSH_CONNECT_TIMEOUT)
+scheduler = PollScheduler(jitter=cfg.SCHEDULE_JITTER, active_factor=cfg.SCHEDULE_ACTIVE_FACTOR,
+                          idle_factor=cfg.SCHEDULE_IDLE_FACTOR, max_backoff=cfg.SCHEDULE_MAX_BACKOFF)
+database = Database(path=cfg.DB_PATH, report_cache_size=cfg.REPORT_CACHE_SIZE)
 
 
 async def spawn_clients():
@@ -32,7 +44,12 @@ async def spawn_clients():
         remote_gpu_workers = [RemoteGPUWorker(context, cmd_dict=cfg.REMOTE_CMD,
                                               host=host, port=cfg.SSH_PORT,
                                               poll_delay=cfg.SSH_INTERVAL,
-                                              timeout=cfg.TIMEOUT) for host in cfg.REMOTE_HOST]
+                                              timeout=cfg.TIMEOUT, ssh_pool=ssh_pool,
+                                              cmd_timeouts=cfg.REMOTE_CMD_TIMEOUTS,
+                                              cmd_intervals=cfg.REMOTE_CMD_INTERVALS,
+                                              stream=cfg.REMOTE_STREAM,
+                                              stream_interval=cfg.STREAM_INTERVAL,
+                                              scheduler=scheduler) for host in cfg.REMOTE_HOST]
         local_disk_workers = [LocalDiskWorker(context, cmd_dict=cfg.LOCAL_CMD,
                                               poll_delay=cfg.LOCAL_INTERVAL)]
         remote_network_workers = [RemoteNetworkWorker(context, cmd_dict=cfg.NETWORK_CMD,
@@ -40,8 +57,16 @@ async def spawn_clients():
                                                       interface=interface,
                                                       host=host, port=cfg.SSH_PORT,
                                                       poll_delay=cfg.NETWORK_INTERVAL,
-                                                      timeout=cfg.TIMEOUT) for host, interface in cfg.NETWORK.items()]
-        local_db_workers = [LocalDBWorker(context, db_path=cfg.DB_PATH, poll_delay=cfg.DB_INTERVAL)]
+                                                      timeout=cfg.TIMEOUT, ssh_pool=ssh_pool,
+                                                      scheduler=scheduler)
+                                  for host, interface in cfg.NETWORK.items()]
+        local_db_workers = [LocalDBWorker(context, db=database, poll_delay=cfg.DB_INTERVAL,
+                                          flush_rows=cfg.DB_FLUSH_ROWS, flush_interval=cfg.DB_FLUSH_INTERVAL,
+                                          buffer_limit=cfg.DB_BUFFER_LIMIT, max_gap=cfg.USAGE_MAX_GAP),
+                            LocalCompactionWorker(context, db=database, poll_delay=cfg.COMPACT_INTERVAL,
+                                                  raw_retention=cfg.RAW_RETENTION_DAYS * 86400,
+                                                  hourly_retention=cfg.HOURLY_RETENTION_DAYS * 86400),
+                            LocalHistoryWorker(context, store=history, poll_delay=cfg.HISTORY_FLUSH_INTERVAL)]
 
         all_workers = remote_gpu_workers + local_disk_workers + remote_network_workers + local_db_workers
         await asyncio.gather(*[worker.run() for worker in all_workers])
@@ -50,14 +75,42 @@ async def spawn_clients():
         raise
 
 
-async def html_handler(request, ws_name='ws'):
-    '''Renders the html page.'''
+VIEW_PARAMS = ['hosts', 'group', 'free']
+
+
+def get_view(query, show_all=False):
+    '''The hosts shown to a client: `?hosts=db15,db16`, `?group=<a group of HOST_GROUPS>`, or else
+    the DEFAULT_GROUP, narrowed to the hosts with a free GPU with `?free=1`. `show_all` shows everything.
+    '''
+    if show_all:
+        return None
+    if query.get('hosts'):
+        hosts = frozenset(host.strip().lower() for host in query['hosts'].split(',') if host.strip())
+    elif query.get('group') or cfg.DEFAULT_GROUP:
+        group = query.get('group') or cfg.DEFAULT_GROUP
+        if group not in cfg.HOST_GROUPS:
+            raise web.HTTPNotFound(text=f'Unknown group: {group}')
+        hosts = frozenset(host.lower() for host in cfg.HOST_GROUPS[group])
+    else:
+        hosts = None
+    free_only = query.get('free', '').lower() in ('1', 'true', 'yes')
+    if hosts is None and not free_only:
+        return None
+    return View(hosts=hosts, free_only=free_only)
+
+
+async def html_handler(request, ws_name='ws', show_all=False):
+    '''Renders the html page. The page renders structured fields, or the converted ANSI with `?view=ansi`.'''
+    get_view(request.query, show_all)  # unknown groups are 404
+    view_query = urlencode([(k, v) for k, v in request.query.items() if k in VIEW_PARAMS])
 
     data = dict(
-        ansi2html_headers=ansi_conv.produce_headers().replace('\n', ' '),
+        ansi2html_headers=renderer.produce_headers().replace('\n', ' '),
         http_host=request.host,
         public_ip=cfg.PUBLIC_IP,
-        ws_name=ws_name,
+        ws_name=ws_name + ('?' + view_query if view_query else ''),
+        view_query=view_query,
+        ws_mode='delta' if request.query.get('view') == 'ansi' else 'data',
         interval=int(cfg.HTML_ASK_INTERVAL * 1000),
     )
     response = aiojinja2.render_template('index.html', request, data)
@@ -65,45 +118,59 @@ async def html_handler(request, ws_name='ws'):
     return response
 
 
-def render_gpustat_body(show_all=False):
-    results = {}
-    body = ''
+def render_gpustat_body(show_all=False, encoding='json', view=None):
+    '''Returns the full payload, shared by all the clients of the view until the context changes.'''
+    return renderer.render_body(encoding, None if show_all else view)
 
-    hosts = cfg.REMOTE_HOST
-    for host in hosts:
-        status = context.get_remote_status(host)
-        if not status:
-            continue
-        body += status
-        # print(status)
-    results['remote_status'] = ansi_conv.convert(body, full=False)
 
-    disk_usage, disk_usage_time = context.get_disk_status()
-    results['disk_status'] = ansi_conv.convert(disk_usage, full=False)
-    results['disk_status_time'] = now_time(disk_usage_time)
+def render_gpustat_delta(since=None, show_all=False, encoding='json', view=None):
+    '''Returns the hosts and sections changed after version `since`, or everything if `since` is None.'''
+    return renderer.render_delta(since, encoding, None if show_all else view)
+
 
-    results['notification'] = ansi_conv.convert(context.get_notification(), full=False)
+def render_gpustat_data(since=None, show_all=False, encoding='json', view=None):
+    '''Like `render_gpustat_delta`, with structured fields instead of html.'''
+    return renderer.render_data(since, encoding, None if show_all else view)
 
-    status, status_time, status_comment = context.get_top_users_status()
-    results['top_users_status'] = status
-    results['top_users_status_time'] = now_time(status_time)
-    results['top_users_status_comment'] = ansi_conv.convert(status_comment, full=False)
 
-    status, status_time = context.get_all_network_status()
-    results['network_status'] = ansi_conv.convert(status, full=False)
-    results['network_status_time'] = now_time(status_time)
+broadcaster = Broadcaster(lambda encoding, view: render_gpustat_body(encoding=encoding, view=view),
+                          lambda since, encoding, view: render_gpustat_delta(since, encoding=encoding, view=view),
+                          lambda since, encoding, view: render_gpustat_data(since, encoding=encoding, view=view),
+                          queue_size=cfg.WS_SEND_QUEUE)
+# the broadcaster is notified once the changed sections are rendered off the event loop,
+# and every CHECKED_PUSH_INTERVAL with the freshness of the hosts polled without changes
+render_events = context.bus.subscribe('render', changed_only=False)
+renderer.add_listener(broadcaster.notify)
+renderer.html_views = broadcaster.html_views
 
-    return json.dumps(results, ensure_ascii=False)
+registry.gauge('gpustat_ws_clients', "Connected websockets, by push mode ('poll' when not subscribed).", ['mode'],
+               lambda: [({'mode': mode}, sum(1 for ws in broadcaster.senders
+                                             if getattr(broadcaster.subscribers.get(ws), 'mode', 'poll') == mode))
+                        for mode in ['poll'] + MODES])
+registry.gauge('gpustat_ws_queued_frames', 'Frames waiting in the send queues of the subscribers.', [],
+               lambda: [({}, sum(s.queue.qsize() for s in broadcaster.subscribers.values()))])
+registry.gauge('gpustat_ssh_in_flight', 'Remote commands running, or waiting for a slot or a connection.', ['state'],
+               lambda: [({'state': 'running'}, ssh_pool.get_stats()['*']['in_flight']),
+                        ({'state': 'waiting'}, ssh_pool.waiting),
+                        ({'state': 'connecting'}, sum(ssh_pool.connecting.values()))])
+registry.gauge('gpustat_context_version', 'Number of changes of the context.', [], lambda: [({}, context.version)])
+registry.gauge('gpustat_bus_events', 'Events of the context per subscription: pending, received, coalesced, dropped.',
+               ['subscription', 'state'],
+               lambda: [({'subscription': name, 'state': state}, value)
+                        for name, stats in context.bus.get_stats().items() for state, value in stats.items()])
 
 
 async def html_handler_debug(request):
     '''Renders the html page debug.'''
+    await renderer.prepare()
 
     data = dict(
-        ansi2html_headers=ansi_conv.produce_headers().replace('\n', ' '),
+        ansi2html_headers=renderer.produce_headers().replace('\n', ' '),
         http_host=request.host,
         public_ip=cfg.PUBLIC_IP,
         ws_name='ws',
+        ws_mode='delta',
+        view_query='',
         interval=int(cfg.HTML_ASK_INTERVAL * 1000),
         result=render_gpustat_body(show_all=True)
     )
@@ -112,26 +179,205 @@ async def html_handler_debug(request):
     return response
 
 
+async def user_handler(request):
+    '''The daily GPU usage of one user in the past 31 days, as html or as json with `?format=json`.'''
+    name = request.match_info['name']
+    report = await database.report_async(name, days=31)
+    if request.query.get('format') == 'json':
+        return web.json_response({'user': name, 'unit': 'GB·h',
+                                  'days': [{'day': day, 'usage': usage} for day, usage in report],
+                                  'total': sum(usage for _, usage in report)})
+    data = dict(user=name, report=report, total=sum(usage for _, usage in report))
+    response = aiojinja2.render_template('user.html', request, data)
+    response.headers['Content-Language'] = 'en'
+    return response
+
+
+async def ssh_pool_handler(request):
+    '''Returns the stats of the shared SSH connections.'''
+    return web.json_response(ssh_pool.get_stats())
+
+
+async def scheduler_handler(request):
+    '''Returns the effective polling rate of each remote worker.'''
+    return web.json_response(scheduler.get_stats())
+
+
+async def clients_handler(request):
+    '''Returns the frames and payload bytes (before permessage-deflate) sent to each websocket client.'''
+    return web.json_response(broadcaster.get_stats())
+
+
+async def metrics_handler(request):
+    '''The self-metrics, in the Prometheus text format or as json with `?format=json`.'''
+    if request.query.get('format') == 'json':
+        return web.json_response(registry.to_dict())
+    return web.Response(text=registry.render_text(), content_type='text/plain', charset='utf-8')
+
+
+def parse_time(text, now, default):
+    '''Epoch seconds, or seconds before `now` if negative.'''
+    if not text:
+        return default
+    try:
+        t = float(text)
+    except ValueError:
+        t = math.nan
+    if not math.isfinite(t):
+        raise web.HTTPBadRequest(text=f'Not a time: {text}')
+    t = now + t if t < 0 else t
+    try:
+        time.gmtime(t)
+    except (OverflowError, OSError, ValueError):
+        raise web.HTTPBadRequest(text=f'Not a time: {text}')
+    return t
+
+
+async def history_handler(request):
+    '''The history of one metric of a host, downsampled to min/max/avg per `step` seconds:
+    `/api/history?host=db15&metric=gpu0.util&from=-3600&to=&step=`. Without `metric`, lists the metrics.
+
+    The ranges still held by the finest tier of `context.timeseries` are read from memory, older ones from `history`.
+    '''
+    query = request.query
+    host = query.get('host', '')
+    if not history.is_valid(host):
+        raise web.HTTPBadRequest(text=f'Bad host: {host}')
+    metric = query.get('metric')
+    if not metric:
+        metrics = set(history.get_metrics(host)) | set(context.timeseries.get_metrics(host))
+        return web.json_response({'host': host, 'metrics': sorted(metrics)})
+    if not history.is_valid(metric):
+        raise web.HTTPBadRequest(text=f'Bad metric: {metric}')
+
+    now = time.time()
+    end = parse_time(query.get('to'), now, now)
+    start = parse_time(query.get('from'), now, end - 3600)
+    if start >= end:
+        raise web.HTTPBadRequest(text='`from` must be before `to`')
+    # nothing is kept beyond, and every day of the range is a file to open
+    start, end = max(start, now - history.retention), min(end, now)
+    if start >= end:
+        raise web.HTTPBadRequest(text=f'Out of the last {cfg.HISTORY_RETENTION_DAYS} days')
+    try:
+        step = float(query['step']) if query.get('step') else (end - start) / cfg.HISTORY_POINTS
+    except ValueError:
+        step = math.nan
+    if not math.isfinite(step):
+        raise web.HTTPBadRequest(text=f"Not a step: {query['step']}")
+    step = max(step, (end - start) / cfg.HISTORY_MAX_POINTS)
+
+    loop = asyncio.get_running_loop()
+    if context.timeseries.covers(host, metric, start):
+        times, values = context.get_metric_history(host, metric, start, end)
+    else:
+        times, values = await loop.run_in_executor(None, history.query, host, metric, start, end)
+    if not times and metric not in history.get_metrics(host) + context.timeseries.get_metrics(host):
+        raise web.HTTPNotFound(text=f'No history of {metric} on {host}')
+    result = await loop.run_in_executor(None, downsample, times, values, start, step)
+    return web.json_response(dict(host=host, metric=metric, step=step, **{'from': start, 'to': end}, **result))
+
+
+def parse_version(text):
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
 async def websocket_handler(request, show_all=False):
+    '''Speaks both protocols over one websocket.
+
+    Poll protocol: "gpustat" is answered with the full payload.
+    Delta protocol: "delta <version>" is answered with the changes after <version>,
+    "data <version>" likewise with structured fields instead of html.
+    Push: "subscribe" (or `?mode=push`) pushes full payloads on every change,
+    "subscribe delta|data" (or `?mode=delta|data`) pushes delta or data frames against
+    the version acknowledged with "ack <version>". "resync" asks for a full frame.
+    Only the hosts of the view are sent, see `get_view`, or all of them on `/wsall`.
+    Frames are json text, or msgpack binary with `?encoding=msgpack`. A frame identical
+    to the last one sent to the client is skipped.
+    '''
     msg_from_host('INFO', f"Websocket connection from {request.remote} established, host {request.host}")
 
-    ws = web.WebSocketResponse()
+    view = get_view(request.query, show_all)
+    # permessage-deflate is used if the client offers it
+    ws = web.WebSocketResponse(compress=cfg.WS_COMPRESS)
     await ws.prepare(request)
+    encoding = request.query.get('encoding', 'json')
+    if encoding not in ENCODINGS:
+        msg_from_host('INFO', f"Unsupported encoding {encoding}, using json", color='yellow')
+        encoding = 'json'
+    # sends the frames, skipping the ones identical to the last one sent
+    sender = broadcaster.connect(ws, encoding=encoding, peer=request.remote, view=view)
+    push_task = None
+
+    def _subscribe(mode='body'):
+        nonlocal push_task
+        if push_task is None:
+            subscriber = broadcaster.subscribe(ws, mode=mode)
+            broadcaster.push(subscriber)
+            push_task = asyncio.create_task(broadcaster.send_loop(subscriber))
+
+    def _unsubscribe():
+        nonlocal push_task
+        broadcaster.unsubscribe(ws)
+        if push_task is not None:
+            push_task.cancel()
+            push_task = None
 
     async def _handle_websocketmessage(msg):
-        if msg.data == 'close':
+        command, _, arg = msg.data.partition(' ')
+        subscriber = broadcaster.subscribers.get(ws)
+        # the html is converted off the event loop before being rendered
+        if command == 'close':
             await ws.close()
+        elif command == 'subscribe':
+            if arg != 'data':
+                await renderer.prepare(view)
+            _subscribe(mode=arg if arg in ('delta', 'data') else 'body')
+        elif command == 'unsubscribe':
+            _unsubscribe()
+        elif command == 'ack':
+            if subscriber is not None:
+                subscriber.acked = parse_version(arg)
+        elif command == 'resync':
+            if subscriber is None or subscriber.mode != 'data':
+                await renderer.prepare(view)
+            if subscriber is not None:
+                subscriber.acked = None
+                sender.last = None
+                broadcaster.push(subscriber)
+            else:
+                sender.last = None
+                await sender.send(render_gpustat_delta(encoding=encoding, view=view))
+        elif command == 'delta':
+            await renderer.prepare(view)
+            await sender.send(render_gpustat_delta(parse_version(arg), encoding=encoding, view=view))
+        elif command == 'data':
+            await sender.send(render_gpustat_data(parse_version(arg), encoding=encoding, view=view))
         else:
-            body = render_gpustat_body(show_all=show_all)
-            await ws.send_str(body)
+            await renderer.prepare(view)
+            body = render_gpustat_body(encoding=encoding, view=view)
+            await sender.send(body)
+
+    mode = request.query.get('mode')
+    if mode in ('push', 'delta', 'data'):
+        if mode != 'data':
+            await renderer.prepare(view)
+        _subscribe(mode='body' if mode == 'push' else mode)
 
-    async for msg in ws:
-        if msg.type == aiohttp.WSMsgType.CLOSE:
-            break
-        elif msg.type == aiohttp.WSMsgType.TEXT:
-            await _handle_websocketmessage(msg)
-        elif msg.type == aiohttp.WSMsgType.ERROR:
-            msg_from_host('ERROR', f"Websocket connection closed with exception {ws.exception()}", color='red')
+    try:
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.CLOSE:
+                break
+            elif msg.type == aiohttp.WSMsgType.TEXT:
+                await _handle_websocketmessage(msg)
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                msg_from_host('ERROR', f"Websocket connection closed with exception {ws.exception()}", color='red')
+    finally:
+        _unsubscribe()
+        broadcaster.disconnect(ws)
 
     msg_from_host('INFO', f"Websocket connection from {request.remote} closed")
     return ws
@@ -140,20 +386,33 @@ async def websocket_handler(request, show_all=False):
 def create_app():
     app = web.Application()
     app.router.add_get('/', lambda r: html_handler(r))
-    app.router.add_get('/all', lambda r: html_handler(r, 'wsall'))
+    app.router.add_get('/all', lambda r: html_handler(r, 'wsall', show_all=True))
     app.router.add_get('/debug', html_handler_debug)
     app.router.add_get('/ws', lambda r: websocket_handler(r))
     app.router.add_get('/wsall', lambda r: websocket_handler(r, show_all=True))
+    app.router.add_get('/user/{name}', user_handler)
+    app.router.add_get('/ssh', ssh_pool_handler)
+    app.router.add_get('/scheduler', scheduler_handler)
+    app.router.add_get('/clients', clients_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/api/history', history_handler)
     # app.add_routes([web.get('/ws', websocket_handler)])
 
     async def start_background_tasks(app):
         app._tasks = asyncio.create_task(spawn_clients())
+        app._render_task = asyncio.create_task(renderer.run(render_events))
         await asyncio.sleep(0.1)
     app.on_startup.append(start_background_tasks)
 
     async def shutdown_background_tasks(app):
         msg_from_host('INFO', "Terminating the application...", color='yellow')
         app._tasks.cancel()
+        app._render_task.cancel()
+        await asyncio.gather(app._tasks, app._render_task, return_exceptions=True)
+        ssh_pool.close()
+        render_executor.shutdown(wait=False)
+        # the connection threads of aiosqlite would keep the process alive
+        await database.close_async()
     app.on_shutdown.append(shutdown_background_tasks)
 
     aiojinja2.setup(app, loader=jinja2.FileSystemLoader(cfg.TEMPLATE_PATH))
@@ -0,0 +1,447 @@
+'''
+Offline benchmark of the whole server against a simulated cluster.
+
+N fake nodes are asyncssh servers answering the REMOTE_CMD commands with
+randomized outputs, after a configurable latency, failing or hanging at
+configurable rates. M websocket clients subscribe to the dashboard. The nodes
+and the clients run in a child process, so the CPU time measured is the
+server's alone.
+
+    python bench.py --nodes 100 --clients 200 --duration 60
+    python bench.py --nodes 10,100,300 --clients 10,300 --duration 30   # one run per combination
+    python bench.py --steady   # the shown readings stay the same, only their noise changes
+
+Reported: end-to-end staleness (node output to client frame), event loop lag,
+server CPU per poll, poll, render and DB read and write times, the polls that changed
+nothing shown, and the frames and payload received (before permessage-deflate).
+The nodes listen on 127.1.x.y loopback addresses, which Linux routes without
+configuration (macOS needs aliases). Nothing touches the real hosts nor usages.db.
+'''
+
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import asyncssh
+
+import config as cfg
+
+STAMP = re.compile(r'bench-(\d+)-(\d+\.\d+)')
+USERS = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'grace', 'heidi']
+
+
+def get_address(i):
+    return f'127.1.{i // 250}.{i % 250 + 1}'
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeNode():
+    '''The state of one simulated host, drifting a little on every poll.
+
+    A `steady` host keeps its shown readings, only the noise below their precision
+    and the fields not shown change, like an idle or a long-running node.
+    '''
+
+    def __init__(self, index, gpus=4, busy=0.5, steady=False):
+        self.index = index
+        self.hostname = f'node{index:03d}'
+        self.busy = random.random() < busy
+        self.gpus = [{'util': 0, 'memory': 5, 'users': {}} for _ in range(gpus)]
+        self.steady = steady
+        self.started = time.time()
+        # rounded, so that the noise stays below the precision shown
+        self.idle = round(random.uniform(5, 99) if self.busy else random.uniform(90, 99), 1)
+        # kB/s of a round number of 0.1 Mb/s
+        self.traffic = [round(random.uniform(0, 40), 1) * 1024 / 8 for _ in range(4)]
+        self.used = round(random.uniform(10, 200) if self.busy else random.uniform(5, 20))
+        for gpu in self.gpus:
+            if self.busy and random.random() < 0.8:
+                gpu['users'] = {random.choice(USERS): random.randint(1000, 10000)}
+            gpu['memory'] = 5 + sum(gpu['users'].values())
+            gpu['util'] = random.randint(30, 100) if gpu['users'] else 0
+
+    def noise(self, scale):
+        return random.uniform(-scale, scale)
+
+    def step(self):
+        if self.steady:
+            return
+        for gpu in self.gpus:
+            if self.busy and random.random() < 0.3:
+                user = random.choice(USERS)
+                gpu['users'] = {user: random.randint(1000, 10000)} if random.random() < 0.8 else {}
+            gpu['memory'] = 5 + sum(gpu['users'].values())
+            gpu['util'] = random.randint(30, 100) if gpu['users'] else 0
+
+    def gpustat(self):
+        self.step()
+        gpus = [{'index': i, 'uuid': f'GPU-{self.index}-{i}', 'name': 'NVIDIA GeForce RTX 3090',
+                 'temperature.gpu': 30 + gpu['util'] // 2, 'fan.speed': gpu['util'] // 2,
+                 'utilization.gpu': gpu['util'], 'power.draw': 20 + 3 * gpu['util'],
+                 'enforced.power.limit': 350, 'memory.used': gpu['memory'], 'memory.total': 24576,
+                 'processes': [{'username': user, 'command': 'python', 'full_command': ['python', 'train.py'],
+                                'gpu_memory_usage': usage, 'cpu_percent': 100.0, 'cpu_memory_usage': 4096,
+                                'pid': 1000 + i}
+                               for user, usage in gpu['users'].items()]}
+                for i, gpu in enumerate(self.gpus)]
+        # the driver version carries the time the output was produced, to measure the staleness on the clients;
+        # the start of a steady node, whose changes are not measured then
+        stamp = self.started if self.steady else time.time()
+        for gpu in gpus:
+            for process in gpu['processes']:
+                process.update(cpu_percent=round(random.uniform(90, 110), 1),
+                               cpu_memory_usage=4096 + random.randint(0, 64))
+        return json.dumps({'hostname': self.hostname, 'driver_version': f'bench-{self.index}-{stamp:.3f}',
+                           'query_time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'gpus': gpus})
+
+    def output(self, key):
+        if key == 'CPU_NEW':
+            if self.steady:
+                idle = self.idle + self.noise(0.02)
+            else:
+                idle = random.uniform(5, 99) if self.busy else random.uniform(90, 99)
+            return f'Linux 5.15.0 ({self.hostname}) _x86_64_ (64 CPU) avg-cpu: %user %nice %system ' \
+                   f'%iowait %steal %idle {100 - idle:.2f} 0.00 0.50 0.00 0.00 {idle:.2f}'
+        if key == 'NETWORK':
+            if self.steady:
+                return '\n'.join(f'{self.traffic[i] + self.noise(0.5):.2f} {self.traffic[i + 1] + self.noise(0.5):.2f}'
+                                 for i in (0, 2))
+            return '\n'.join(f'{random.uniform(0, 5000):.2f} {random.uniform(0, 5000):.2f}' for _ in range(2))
+        if key == 'MEM':
+            if self.steady:
+                used = self.used
+            else:
+                used = random.uniform(10, 200) if self.busy else random.uniform(5, 20)
+            return '               total        used        free      shared  buff/cache   available\n' \
+                   f'Mem:           251G       {used:.0f}G       10G       0.1G        20G       {251 - used:.0f}G\n' \
+                   'Swap:            0B          0B          0B'
+        if key == 'CUDA':
+            return 'bin\ncuda\ncuda-11.8\ncuda-12.1\netc\ninclude\nlib\nshare\nsrc'
+        if key == 'GPUSTAT':
+            return self.gpustat()
+        raise KeyError(key)
+
+
+class FakeServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        # anyone gets in
+        return False
+
+
+async def serve_node(node, args, stats):
+    '''Answers the commands of `Worker.set_cmd_line`, either one command per channel or all of them in sections.'''
+
+    async def handle(process):
+        stats['commands'] += 1
+        command = process.command or ''
+        await asyncio.sleep(max(0.0, random.gauss(args.latency, args.latency / 4)))
+        draw = random.random()
+        if draw < args.hang:
+            stats['hangs'] += 1
+            await asyncio.sleep(3600)
+        elif draw < args.hang + args.fail:
+            stats['failures'] += 1
+            process.stderr.write('bench: simulated failure\n')
+            process.exit(1)
+            return
+        keys = [k for k in cfg.REMOTE_CMD if f'<START {k}>' in command]
+        if keys:
+            process.stdout.write(''.join(f'<START {k}>\n{node.output(k)}\n<END {k}>\n' for k in keys))
+        else:
+            key = next((k for k, v in cfg.REMOTE_CMD.items() if v == command), None)
+            if key is None:
+                process.stderr.write(f'bench: command not simulated: {command[:40]}\n')
+                process.exit(127)
+                return
+            process.stdout.write(node.output(key) + '\n')
+        process.exit(0)
+
+    return await asyncssh.listen(get_address(node.index), args.ssh_port, server_factory=FakeServer,
+                                 server_host_keys=[args.host_key], process_factory=handle)
+
+
+async def run_client(i, args, stats, start):
+    '''One dashboard page, subscribed like the page itself, acknowledging every frame.'''
+    import aiohttp
+    last_stamps = {}
+    url = f'http://127.0.0.1:{args.app_port}/ws'
+    if args.mode != 'poll':
+        url += f'?mode={args.mode}'
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                ws = await session.ws_connect(url)
+                break
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+        else:
+            return
+        stats['connected'] += 1
+
+        async def poll():
+            while not ws.closed:
+                await ws.send_str('gpustat')
+                await asyncio.sleep(cfg.HTML_ASK_INTERVAL)
+        poller = asyncio.create_task(poll()) if args.mode == 'poll' else None
+
+        async for msg in ws:
+            now = time.time()
+            text = msg.data if isinstance(msg.data, str) else ''
+            if now - start > args.warmup:
+                stats['frames'] += 1
+                stats['bytes'] += len(text.encode('utf-8'))
+            if args.mode in ('delta', 'data'):
+                version = re.search(r'"version":\s*(\d+)', text)
+                if version:
+                    await ws.send_str(f'ack {version.group(1)}')
+            for node, stamp in STAMP.findall(text):
+                stamp = float(stamp)
+                # only the first sight of an output counts, unchanged hosts are sent again in full frames
+                if last_stamps.get(node, 0) < stamp:
+                    last_stamps[node] = stamp
+                    if now - start > args.warmup:
+                        stats['staleness'].append(now - stamp)
+        if poller is not None:
+            poller.cancel()
+
+
+def run_load(args, ready, stop, results):
+    '''The child process: the fake nodes, then the clients once the server is up, until `stop` is set.'''
+
+    async def main():
+        stats = {'commands': 0, 'failures': 0, 'hangs': 0, 'connected': 0, 'frames': 0, 'bytes': 0,
+                 'staleness': []}
+        args.host_key = asyncssh.generate_private_key('ssh-ed25519')
+        nodes = [FakeNode(i, gpus=args.gpus, busy=args.busy, steady=args.steady) for i in range(args.nodes)]
+        servers = [await serve_node(node, args, stats) for node in nodes]
+        ready.set()
+        start = time.time()
+        clients = [asyncio.create_task(run_client(i, args, stats, start)) for i in range(args.clients)]
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        for client in clients:
+            client.cancel()
+        for server in servers:
+            server.close()
+        results.put(stats)
+
+    asyncio.run(main())
+
+
+def get_histogram(metric, **labels):
+    '''(counts, sum, count) of the samples of `metric` matching `labels`, summed over the other labels.'''
+    counts, total, count = [0] * (len(metric.buckets) + 1), 0.0, 0
+    for key, value in metric.values.items():
+        if all(metric.get_labels(key).get(k) == v for k, v in labels.items()):
+            counts = [a + b for a, b in zip(counts, value.counts)]
+            total += value.sum
+            count += value.count
+    return counts, total, count
+
+
+def summarize_histogram(metric, before, **labels):
+    '''Mean and p95 in ms of the samples observed since the `before` snapshot of `get_histogram`.'''
+    from metrics import HistogramValue
+    counts, total, count = get_histogram(metric, **labels)
+    value = HistogramValue(metric.buckets)
+    value.counts = [a - b for a, b in zip(counts, before[0])]
+    value.sum, value.count, value.max = total - before[1], count - before[2], math.inf
+    if not value.count:
+        return {'count': 0, 'mean_ms': None, 'p95_ms': None}
+    return {'count': value.count, 'mean_ms': round(1000 * value.sum / value.count, 3),
+            'p95_ms': round(1000 * metric.quantile(value, 0.95), 3)}
+
+
+def summarize(samples):
+    '''p50, p95 and max in ms.'''
+    if not samples:
+        return {'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+    samples = sorted(samples)
+    return {'p50_ms': round(1000 * samples[len(samples) // 2], 1),
+            'p95_ms': round(1000 * samples[min(len(samples) - 1, int(0.95 * len(samples)))], 1),
+            'max_ms': round(1000 * samples[-1], 1)}
+
+
+async def monitor_lag(samples, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+def configure(args, tmpdir):
+    '''Points the config at the fake nodes, before `app` reads it.'''
+    cfg.REMOTE_HOST = [get_address(i) for i in range(args.nodes)]
+    cfg.SSH_PORT = args.ssh_port
+    cfg.SSH_INTERVAL = args.interval
+    cfg.NETWORK = {}
+    cfg.LOCAL_CMD = {'DISK': 'echo "/dev/sda1 1.8T 1.2T 600G 67% /D"', 'NOTIFICATION': 'echo benchmark'}
+    cfg.DB_PATH = os.path.join(tmpdir, 'usages.db')
+    cfg.DB_INTERVAL = args.db_interval
+    cfg.DB_FLUSH_INTERVAL = args.db_interval
+    cfg.HISTORY_PATH = os.path.join(tmpdir, 'history')
+    cfg.HISTORY_FLUSH_INTERVAL = args.db_interval
+    if args.joined:
+        cfg.REMOTE_CMD_TIMEOUTS = None
+
+
+async def run_server(args, stop):
+    from aiohttp import web
+
+    import app as server
+    from db import DB_SECONDS
+    from render import RENDER_SECONDS
+    from workers.remote_gpu_worker import UNCHANGED
+    from workers.worker import ERRORS, POLL_SECONDS
+
+    runner = web.AppRunner(server.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.app_port).start()
+    lags = []
+    monitor = asyncio.create_task(monitor_lag(lags))
+
+    await asyncio.sleep(args.warmup)
+    histograms = {'poll': (POLL_SECONDS, {'worker_type': 'remote-gpu'}),
+                  'db_read': (DB_SECONDS, {'op': 'past_windows'}),
+                  'db_insert': (DB_SECONDS, {'op': 'insert'})}
+    histograms.update((f'render_{kind}', (RENDER_SECONDS, {'kind': kind})) for kind in ['body', 'delta', 'data'])
+    before = {name: get_histogram(metric, **labels) for name, (metric, labels) in histograms.items()}
+    errors_before = sum(ERRORS.values.values())
+    unchanged_before = sum(UNCHANGED.values.values())
+    del lags[:]
+    cpu_start, wall_start = time.process_time(), time.time()
+
+    await asyncio.sleep(args.duration)
+    cpu, wall = time.process_time() - cpu_start, time.time() - wall_start
+    report = {name: summarize_histogram(metric, before[name], **labels)
+              for name, (metric, labels) in histograms.items()}
+    polls = report['poll']['count']
+    report.update(loop_lag=summarize(lags),
+                  cpu={'percent': round(100 * cpu / wall, 1),
+                       'per_poll_ms': round(1000 * cpu / polls, 3) if polls else None},
+                  polls_per_s=round(polls / wall, 2),
+                  worker_errors=sum(ERRORS.values.values()) - errors_before,
+                  unchanged_percent=round(100 * (sum(UNCHANGED.values.values()) - unchanged_before) / polls, 1)
+                  if polls else None)
+    monitor.cancel()
+    # the clients leave first, the server waits for the open websockets on cleanup
+    stop.set()
+    await asyncio.sleep(1)
+    await runner.cleanup()
+    return report
+
+
+def run_once(args):
+    args.app_port = args.app_port or get_free_port()
+    ready, stop, results = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Queue()
+    load = multiprocessing.Process(target=run_load, args=(args, ready, stop, results), daemon=True)
+    load.start()
+    if not ready.wait(60):
+        sys.exit('The fake nodes did not start.')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        configure(args, tmpdir)
+        # the server logs every poll, kept out of the report
+        log = io.StringIO() if not args.verbose else sys.stdout
+        with contextlib.redirect_stdout(log):
+            report = asyncio.run(run_server(args, stop))
+    clients = results.get(timeout=60)
+    load.join(10)
+
+    report = dict(nodes=args.nodes, clients=args.clients, mode=args.mode, **report)
+    report['staleness'] = summarize(clients['staleness'])
+    report['frames_per_client_s'] = round(clients['frames'] / max(1, clients['connected']) / args.duration, 2)
+    report['kb_per_client_s'] = round(clients['bytes'] / 1024 / max(1, clients['connected']) / args.duration, 2)
+    report['clients_connected'] = clients['connected']
+    report['node_commands'] = clients['commands']
+    return report
+
+
+COLUMNS = [('nodes', lambda r: r['nodes']), ('clients', lambda r: r['clients']),
+           ('polls/s', lambda r: r['polls_per_s']), ('cpu%', lambda r: r['cpu']['percent']),
+           ('cpu/poll ms', lambda r: r['cpu']['per_poll_ms']),
+           ('stale p50', lambda r: r['staleness']['p50_ms']), ('stale p95', lambda r: r['staleness']['p95_ms']),
+           ('lag p95', lambda r: r['loop_lag']['p95_ms']), ('lag max', lambda r: r['loop_lag']['max_ms']),
+           ('poll p95', lambda r: r['poll']['p95_ms']),
+           ('render ms', lambda r: r['render_data' if r['mode'] == 'data' else 'render_delta']['mean_ms']),
+           ('db read ms', lambda r: r['db_read']['mean_ms']), ('db write ms', lambda r: r['db_insert']['mean_ms']),
+           ('unchanged%', lambda r: r['unchanged_percent']),
+           ('payload kB/client/s', lambda r: r['kb_per_client_s']), ('errors', lambda r: r['worker_errors'])]
+
+
+def print_table(reports):
+    rows = [[name for name, _ in COLUMNS]] + [[str(get(r)) for _, get in COLUMNS] for r in reports]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+    for row in rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', default='20', help='fake nodes, or a comma-separated list to sweep')
+    parser.add_argument('--clients', default='20', help='websocket clients, or a comma-separated list to sweep')
+    parser.add_argument('--mode', default='data', choices=['data', 'delta', 'push', 'poll'],
+                        help='how the clients get the dashboard')
+    parser.add_argument('--duration', type=float, default=30, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=None, help='seconds before measuring, two intervals by default')
+    parser.add_argument('--interval', type=float, default=cfg.SSH_INTERVAL, help='SSH_INTERVAL of the nodes')
+    parser.add_argument('--db-interval', type=float, default=10, help='DB_INTERVAL and DB_FLUSH_INTERVAL')
+    parser.add_argument('--latency', type=float, default=0.2, help='mean seconds for a node to answer a command')
+    parser.add_argument('--fail', type=float, default=0.0, help='ratio of the commands exiting with an error')
+    parser.add_argument('--hang', type=float, default=0.0, help='ratio of the commands never answering')
+    parser.add_argument('--gpus', type=int, default=4, help='GPUs per node')
+    parser.add_argument('--busy', type=float, default=0.5, help='ratio of the nodes running jobs')
+    parser.add_argument('--steady', action='store_true', help='the nodes keep their shown readings, only their noise changes')
+    parser.add_argument('--joined', action='store_true', help='run all the commands of a poll on one channel')
+    parser.add_argument('--ssh-port', type=int, default=2222)
+    parser.add_argument('--app-port', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the reports as json')
+    parser.add_argument('--verbose', action='store_true', help='keep the server log')
+    args = parser.parse_args()
+    if args.warmup is None:
+        args.warmup = 2 * args.interval
+    return args
+
+
+def main():
+    args = get_args()
+    sizes = list(itertools.product([int(n) for n in args.nodes.split(',')],
+                                   [int(m) for m in args.clients.split(',')]))
+    if len(sizes) == 1:
+        args.nodes, args.clients = sizes[0]
+        reports = [run_once(args)]
+    else:
+        # a fresh process per run, the server keeps module-level state
+        reports = []
+        argv = [a for a in sys.argv[1:] if a != '--json']
+        for nodes, clients in sizes:
+            run_argv = argv + ['--nodes', str(nodes), '--clients', str(clients), '--json']
+            print(f'{nodes} nodes, {clients} clients...', file=sys.stderr)
+            output = subprocess.run([sys.executable, __file__] + run_argv, capture_output=True, text=True, check=True)
+            reports += json.loads(output.stdout)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print_table(reports)
+
+
+if __name__ == '__main__':
+    main()
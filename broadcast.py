@@ -0,0 +1,175 @@
+import asyncio
+
+from metrics import registry
+from utils import msg_from_host
+
+
+MODES = ['body', 'delta', 'data']
+
+FRAMES = registry.counter('gpustat_ws_frames_total', 'Websocket frames sent, skipped as repeats or dropped by slow clients.',
+                          ['result'])
+# aiohttp does not expose the size of the frames after permessage-deflate
+PAYLOAD_BYTES = registry.counter('gpustat_ws_payload_bytes_total', 'Websocket payload bytes sent, before permessage-deflate.',
+                                 ['encoding'])
+
+
+class FrameSender():
+    '''Sends the frames of one websocket, skipping a frame identical to the last one sent, and counts the payload bytes.'''
+
+    def __init__(self, ws, encoding='json', peer='', view=None):
+        self.ws = ws
+        self.encoding = encoding
+        self.view = view
+        self.peer = peer
+        self.last = None
+        self.frames = 0
+        self.payload_bytes = 0
+        self.skipped = 0
+
+    async def send(self, frame):
+        if frame == self.last:
+            self.skipped += 1
+            FRAMES.inc(result='skipped')
+            return False
+        if isinstance(frame, bytes):
+            await self.ws.send_bytes(frame)
+            size = len(frame)
+        else:
+            await self.ws.send_str(frame)
+            size = len(frame.encode('utf-8'))
+        self.payload_bytes += size
+        self.frames += 1
+        FRAMES.inc(result='sent')
+        PAYLOAD_BYTES.inc(size, encoding=self.encoding)
+        self.last = frame
+        return True
+
+    def get_stats(self):
+        # the payload is counted before permessage-deflate, if `compress` was negotiated
+        return {'peer': self.peer, 'encoding': self.encoding, 'compress': bool(self.ws.compress),
+                'view': None if self.view is None else {'hosts': sorted(self.view.hosts or []) or None,
+                                                        'free_only': self.view.free_only},
+                'frames': self.frames, 'payload_bytes': self.payload_bytes, 'skipped': self.skipped,
+                'payload_bytes_per_frame': round(self.payload_bytes / self.frames) if self.frames else None}
+
+
+class Subscriber():
+    '''A pushed websocket.
+
+    `mode` is 'body' (the full payload), 'delta' (html of the changes) or 'data'
+    (structured fields of the changes). Changes are computed against the last
+    version it acknowledged.
+    '''
+
+    def __init__(self, ws, queue_size=2, mode='body', sender=None):
+        self.ws = ws
+        self.sender = sender or FrameSender(ws)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.mode = mode
+        self.acked = None
+
+
+class Broadcaster():
+    '''Pushes rendered payloads to all the subscribed websockets when the context changes.
+
+    Each subscriber owns a bounded send queue. When a slow client falls behind,
+    the oldest queued frame is dropped, since only the newest one matters.
+    Subscribers sharing the same acknowledged version, encoding and view share one rendered frame.
+    Every connected websocket, subscribed or not, sends through its `FrameSender`.
+    '''
+
+    def __init__(self, render_body, render_delta, render_data=None, queue_size=2):
+        self.render_body = render_body
+        self.render_delta = render_delta
+        self.render_data = render_data
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self.senders = {}
+        self.dropped = 0
+        self.closed = {'clients': 0, 'frames': 0, 'payload_bytes': 0, 'skipped': 0}
+        self._scheduled = False
+
+    def connect(self, ws, encoding='json', peer='', view=None):
+        self.senders[ws] = FrameSender(ws, encoding=encoding, peer=peer, view=view)
+        return self.senders[ws]
+
+    def disconnect(self, ws):
+        self.unsubscribe(ws)
+        sender = self.senders.pop(ws, None)
+        if sender is not None:
+            self.closed['clients'] += 1
+            for key in ['frames', 'payload_bytes', 'skipped']:
+                self.closed[key] += getattr(sender, key)
+
+    def subscribe(self, ws, mode='body'):
+        sender = self.senders.get(ws) or self.connect(ws)
+        subscriber = Subscriber(ws, queue_size=self.queue_size, mode=mode, sender=sender)
+        self.subscribers[ws] = subscriber
+        return subscriber
+
+    def unsubscribe(self, ws):
+        self.subscribers.pop(ws, None)
+
+    def html_views(self):
+        '''The views of the subscribers pushed html.'''
+        return set(subscriber.sender.view for subscriber in self.subscribers.values() if subscriber.mode != 'data')
+
+    def notify(self, version=None):
+        '''Context listener. Updates within the same loop iteration are coalesced into one fan-out.'''
+        if self._scheduled or not self.subscribers:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._scheduled = True
+        loop.call_soon(self.fan_out)
+
+    def render_for(self, subscriber):
+        encoding, view = subscriber.sender.encoding, subscriber.sender.view
+        if subscriber.mode == 'data':
+            return self.render_data(subscriber.acked, encoding, view)
+        if subscriber.mode == 'delta':
+            return self.render_delta(subscriber.acked, encoding, view)
+        return self.render_body(encoding, view)
+
+    def fan_out(self):
+        self._scheduled = False
+        frames = {}
+        for subscriber in list(self.subscribers.values()):
+            key = (subscriber.mode, subscriber.acked, subscriber.sender.encoding, subscriber.sender.view)
+            if key not in frames:
+                frames[key] = self.render_for(subscriber)
+            self.put_latest(subscriber.queue, frames[key])
+
+    def put_latest(self, queue, body):
+        if queue.full():
+            queue.get_nowait()
+            self.dropped += 1
+            FRAMES.inc(result='dropped')
+        queue.put_nowait(body)
+
+    def push(self, subscriber):
+        '''Queues a frame for one subscriber right away, e.g. on subscribing or on resync.'''
+        self.put_latest(subscriber.queue, self.render_for(subscriber))
+
+    async def send_loop(self, subscriber):
+        '''Drains the queue of one subscriber into its websocket.'''
+        ws = subscriber.ws
+        try:
+            while not ws.closed:
+                body = await subscriber.queue.get()
+                await subscriber.sender.send(body)
+        except (ConnectionResetError, RuntimeError) as ex:
+            msg_from_host('INFO', f"Websocket push stopped: {ex}")
+        finally:
+            self.unsubscribe(ws)
+
+    def get_stats(self):
+        clients = [dict(sender.get_stats(), mode=getattr(self.subscribers.get(ws), 'mode', None))
+                   for ws, sender in self.senders.items()]
+        total = dict(self.closed)
+        total['clients'] += len(clients)
+        for key in ['frames', 'payload_bytes', 'skipped']:
+            total[key] += sum(client[key] for client in clients)
+        return {'clients': clients, 'total': total, 'dropped': self.dropped}
@@ -2,14 +2,35 @@ from pathlib import Path
 
 
 REMOTE_HOST = [f'db{i}' for i in list(range(15, 20))]
+# views of a subset of the hosts, e.g. `/?group=vision`; `/all` always shows every host
+HOST_GROUPS = {
+    # 'vision': ['db15', 'db16'],
+}
+DEFAULT_GROUP = None  # the group shown by `/` without `?hosts=` nor `?group=`
+FREE_GPU_MEMORY = 1000  # MB, a GPU without processes using at most this much is free (`?free=1`)
 SSH_PORT = 22
 SSH_INTERVAL = 8
 TIMEOUT = 80
+SSH_MAX_CHANNELS = 8  # concurrent commands over the one shared connection per host
+SSH_MAX_IN_FLIGHT = 32  # concurrent commands over all the hosts
+SSH_CONNECT_TIMEOUT = 10
 REMOTE_CMD = {'CPU_NEW': "echo `iostat -c 1 2`",
               'NETWORK': "sar -n DEV 1 2 | grep -E '(Average|平均)+' | grep -vw lo | grep -v rxkB/s | awk '{{print $5, $6}}'",
               'MEM': "free -h",
               'CUDA': "ls /usr/local",
-              'GPUSTAT': "gpustat -P --color --gpuname-width 16"}
+              'GPUSTAT': "gpustat --json"}  # "gpustat -P --color --gpuname-width 16" still works
+# per-command deadlines in seconds: the commands run separately, a late one is shown with its last result
+REMOTE_CMD_TIMEOUTS = {'CPU_NEW': 10, 'NETWORK': 10, 'MEM': 10, 'CUDA': 10, 'GPUSTAT': 30}
+# seconds between the runs of slow-changing commands, their last result is shown in between
+REMOTE_CMD_INTERVALS = {'CUDA': 3600}
+# stream samples from a long-lived agent on each node (needs python3 there) instead of polling REMOTE_CMD
+REMOTE_STREAM = False
+STREAM_INTERVAL = 1
+# adaptive polling of the remote hosts, relative to their interval
+SCHEDULE_JITTER = 0.2  # +-20% on every delay
+SCHEDULE_ACTIVE_FACTOR = 0.5  # hosts running GPU jobs
+SCHEDULE_IDLE_FACTOR = 4  # max slowdown of unchanged hosts
+SCHEDULE_MAX_BACKOFF = 300  # seconds, for unreachable hosts
 
 NOTIFICATION_FILE = './notification.txt'
 LOCAL_CMD = {'DISK': 'df -h | grep /D',
@@ -26,10 +47,34 @@ NETWORK_CMD = {
     'NETWORK': "sar -n DEV 1 {t} | grep -E '(Average|平均)+' | grep -vw lo | grep -v rxkB/s | grep -w {em} | awk '{{print $5, $6}}'"
 }
 
+# in-memory metric history: (resolution, retention) in seconds, finest first
+TIMESERIES_TIERS = [(1, 3600), (60, 24 * 3600)]
+# persistent metric history of /api/history: one append-only file per host, metric and day
+HISTORY_PATH = 'history'
+HISTORY_FLUSH_INTERVAL = 30
+HISTORY_RETENTION_DAYS = 30
+HISTORY_POINTS = 300  # buckets returned without `step`, about the width of a chart
+HISTORY_MAX_POINTS = 2000
+
 DB_PATH = 'usages.db'
-DB_INTERVAL = 60
+DB_INTERVAL = 60  # seconds between the reads of the top users
+# the usage of every report is buffered, and written once this many rows or seconds are pending
+DB_FLUSH_ROWS = 1000
+DB_FLUSH_INTERVAL = 60
+DB_BUFFER_LIMIT = 100000  # rows kept while the writes fail, older minutes are merged beyond
+USAGE_MAX_GAP = 120  # seconds, a host silent for longer is not accounted for the gap
+# raw samples and hourly rollups older than these are deleted in the background; daily rollups are kept
+COMPACT_INTERVAL = 3600
+RAW_RETENTION_DAYS = 8
+HOURLY_RETENTION_DAYS = 90
+REPORT_CACHE_SIZE = 256  # per-user reports of /user/<name>
 
 TEMPLATE_PATH = str(Path(__file__).parent / 'template')
 HTML_ASK_INTERVAL = 8
+RENDER_POOL = 'thread'  # where the ANSI to HTML conversion runs: 'thread' or 'process'
+RENDER_WORKERS = 2
+CHECKED_PUSH_INTERVAL = 2  # seconds between the pushes of the hosts polled without changes
+WS_COMPRESS = True  # permessage-deflate when the client offers it, as aiohttp does by default; False turns it off
+WS_SEND_QUEUE = 2  # frames buffered per pushed websocket, older ones are dropped
 SERVICE_PORT = 30000
 PUBLIC_IP = 'localhost:30000'
@@ -1,20 +1,108 @@
+import asyncio
 import collections
-from collections import defaultdict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
 from utils import now_time, escape_ansi
 from termcolor import colored, cprint
+from timeseries import TimeSeriesStore
 import time
 
 
-Info = namedtuple('Info', ['is_success', 'msg', 'update_time', 'comment'],
-                  defaults=[True, '', 0.0, ''])
+# `data` holds the structured fields of `msg`, for the clients rendering them themselves
+Info = namedtuple('Info', ['is_success', 'msg', 'update_time', 'comment', 'data'],
+                  defaults=[True, '', 0.0, '', None])
+
+# `section` is e.g. ('remote', 'db15') or 'disk'. `changed` is False when only the freshness
+# of the section was updated, see `Context.touch_remote_status`
+Event = namedtuple('Event', ['section', 'version', 'time', 'changed'], defaults=[True])
+
+
+def get_event_type(section):
+    ''' 'remote' for ('remote', 'db15'), 'disk' for 'disk'. '''
+    return section[0] if isinstance(section, tuple) else section
+
+
+class Subscription():
+    '''A bounded queue of events, coalesced per section: a newer event replaces the queued one of its section.
+
+    Only the events of `types` (all if None) are queued, and only the changes with `changed_only`.
+    When `maxsize` sections are queued, the oldest is dropped.
+    '''
+
+    def __init__(self, name, types=None, changed_only=True, maxsize=256):
+        self.name = name
+        self.types = None if types is None else set(types)
+        self.changed_only = changed_only
+        self.maxsize = maxsize
+        self.pending = OrderedDict()
+        self.ready = asyncio.Event()
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, event):
+        if self.changed_only and not event.changed:
+            return
+        if self.types is not None and get_event_type(event.section) not in self.types:
+            return
+        self.received += 1
+        if event.section in self.pending:
+            del self.pending[event.section]
+            self.coalesced += 1
+        elif len(self.pending) >= self.maxsize:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+        self.pending[event.section] = event
+        self.ready.set()
+
+    async def get(self):
+        '''Waits for events, then returns all the queued ones.'''
+        await self.ready.wait()
+        self.ready.clear()
+        events = list(self.pending.values())
+        self.pending.clear()
+        return events
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    def get_stats(self):
+        return {'pending': len(self.pending), 'received': self.received,
+                'coalesced': self.coalesced, 'dropped': self.dropped}
+
+
+class EventBus():
+    '''Publishes the changes of the context to the subscriptions, which consume them at their own pace.'''
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def subscribe(self, name, types=None, changed_only=True, maxsize=256):
+        subscription = Subscription(name, types=types, changed_only=changed_only, maxsize=maxsize)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def publish(self, event):
+        for subscription in self.subscriptions:
+            subscription.put(event)
+
+    def get_stats(self):
+        return {subscription.name: subscription.get_stats() for subscription in self.subscriptions}
 
 
 class Context(object):
     '''The global context object.'''
 
-    def __init__(self):
+    def __init__(self, timeseries_tiers=((1, 3600), (60, 24 * 3600)), history=None):
         self.data = defaultdict(str)
         self.remote_status = defaultdict(Info)
+        self.gpu_status = {}
         self.disk_status = Info()
         self.network_status = defaultdict(Info)
 
@@ -26,18 +114,56 @@ class Context(object):
         self.db_last_write = Info()
         self.db_last_read = Info()
 
+        # in-memory history of the numeric metrics, see `record_metrics`
+        self.timeseries = TimeSeriesStore(timeseries_tiers)
+        # the persistent history, a `timeseries.MetricStore`, if any
+        self.history = history
+
+        # generation counter, bumped by every `update_*` call
+        self.version = 0
+        # section -> the version it was last changed at
+        self.section_versions = {}
+        # the changes are published as `Event`s, consumers subscribe with `bus.subscribe`
+        self.bus = EventBus()
+
     def all_data(self):
         pass
 
-    def update_remote_status(self, host, msg_or_comment, is_success=True):
-        ''' If is_success, update the msg field. Otherwise update the comment field. '''
+    def bump_version(self, section=None):
+        '''Marks the context (and `section`) as changed, so anything rendered from an older version is stale.'''
+        self.version += 1
+        if section is not None:
+            self.section_versions[section] = self.version
+            self.bus.publish(Event(section, self.version, time.time()))
+        return self.version
+
+    def get_section_version(self, section):
+        return self.section_versions.get(section, 0)
+
+    def changed_sections(self, since):
+        '''Returns the sections changed after version `since`.'''
+        return [section for section, version in self.section_versions.items() if version > since]
+
+    def update_remote_status(self, host, msg_or_comment, is_success=True, data=None):
+        ''' If is_success, update the msg (and data) field. Otherwise update the comment field. '''
         if is_success:
             self.remote_status[host] = Info(is_success=True, update_time=time.time(),
-                                            msg=f'{msg_or_comment}\n')
+                                            msg=f'{msg_or_comment}\n', data=data)
         else:
-            msg = self.remote_status[host].msg
-            self.remote_status[host] = Info(is_success=False, update_time=time.time(), msg=msg,
+            last = self.remote_status[host]
+            self.remote_status[host] = Info(is_success=False, update_time=time.time(), msg=last.msg, data=last.data,
                                             comment=colored(f"({host}) ", 'white') + f'{msg_or_comment}')
+        self.bump_version(('remote', host))
+
+    def touch_remote_status(self, host):
+        ''' Marks the unchanged status of the host as fresh, without bumping the version.
+        Returns False if there is no successful status to keep. '''
+        status = self.remote_status.get(host)
+        if status is None or not status.is_success:
+            return False
+        status = self.remote_status[host] = status._replace(update_time=time.time())
+        self.bus.publish(Event(('remote', host), self.version, status.update_time, changed=False))
+        return True
 
     def get_remote_status(self, host):
         status = self.remote_status[host]
@@ -49,17 +175,54 @@ class Context(object):
                 '\n' if len(cached.split('\n')) > 1 else '') + f"{cached}"
             return result if result.endswith('\n') else result + '\n'
 
+    @staticmethod
+    def get_info_data(status):
+        '''The structured fields of `status`, with the plain text `error` when the last update failed.'''
+        data = dict(status.data or {})
+        if not status.is_success:
+            data['error'] = escape_ansi(status.comment)
+        return data
+
+    def get_remote_data(self, host):
+        return self.get_info_data(self.remote_status[host])
+
     def get_all_remote_status(self):
         return self.remote_status
 
-    def update_disk_status(self, msg_or_comment, is_success=True):
+    def update_gpu_status(self, host, gpustat):
+        ''' `gpustat` is the `gpu.GPUStat` record of the host. '''
+        self.gpu_status[host] = gpustat
+        self.bump_version(('gpu', host))
+
+    def get_gpu_status(self, host):
+        return self.gpu_status.get(host)
+
+    def count_free_gpus(self, host, max_memory=1000):
+        ''' GPUs without processes and using at most `max_memory` MB. 0 if unknown. '''
+        gpustat = self.gpu_status.get(host)
+        if gpustat is None:
+            return 0
+        return sum(1 for gpu in gpustat.gpus if not gpu.processes and gpu.memory_used <= max_memory)
+
+    def record_metrics(self, host, metrics, t=None):
+        ''' Appends {metric: value} to the history of the host. Not rendered, so the version is not bumped. '''
+        t = time.time() if t is None else t
+        self.timeseries.record(host, metrics, t)
+        if self.history is not None:
+            self.history.append(host, metrics, t)
+
+    def get_metric_history(self, host, metric, start=None, end=None):
+        return self.timeseries.query(host, metric, start, end)
+
+    def update_disk_status(self, msg_or_comment, is_success=True, data=None):
         if is_success:
             self.disk_status = Info(is_success=True, update_time=time.time(),
-                                    msg=msg_or_comment)
+                                    msg=msg_or_comment, data=data)
         else:
-            msg = self.disk_status.msg
+            last = self.disk_status
             self.disk_status = Info(is_success=False, update_time=time.time(),
-                                    msg=msg, comment=msg_or_comment)
+                                    msg=last.msg, comment=msg_or_comment, data=last.data)
+        self.bump_version('disk')
 
     def get_disk_status(self):
         status = self.disk_status
@@ -70,15 +233,19 @@ class Context(object):
             result = f'{status.comment} Cached info: {cached}'
             return result if result.endswith('\n') else result + '\n', status.update_time
 
-    def update_network_status(self, host, msg_or_comment, is_success=True):
-        ''' If is_success, update the msg field. Otherwise update the comment field. '''
+    def get_disk_data(self):
+        return self.get_info_data(self.disk_status), self.disk_status.update_time
+
+    def update_network_status(self, host, msg_or_comment, is_success=True, data=None):
+        ''' If is_success, update the msg (and data) field. Otherwise update the comment field. '''
         if is_success:
             self.network_status[host] = Info(is_success=True, update_time=time.time(),
-                                             msg=f'{msg_or_comment}\n')
+                                             msg=f'{msg_or_comment}\n', data=data)
         else:
-            msg = self.network_status[host].msg
-            self.network_status[host] = Info(is_success=False, update_time=time.time(), msg=msg,
+            last = self.network_status[host]
+            self.network_status[host] = Info(is_success=False, update_time=time.time(), msg=last.msg, data=last.data,
                                              comment=colored(f"({host}) ", 'white') + f'{msg_or_comment}')
+        self.bump_version('network')
 
     def get_network_status(self, host):
         status = self.network_status[host]
@@ -98,6 +265,10 @@ class Context(object):
             max_time = max(max_time, info.update_time)
         return res, max_time
 
+    def get_all_network_data(self):
+        max_time = max([info.update_time for info in self.network_status.values()], default=0)
+        return {host: self.get_info_data(info) for host, info in self.network_status.items()}, max_time
+
     def update_top_users_status(self, top_dict_or_comment, is_success=True):
         if is_success:
             for topK, v in top_dict_or_comment.items():
@@ -106,6 +277,7 @@ class Context(object):
             self.top_users_comment = ''
         else:
             self.top_users_comment = top_dict_or_comment
+        self.bump_version('top_users')
 
     def get_top_users_status(self):
         top_users = {}
@@ -115,6 +287,7 @@ class Context(object):
 
     def update_notification(self, msg):
         self.notification = msg
+        self.bump_version('notification')
 
     def get_notification(self):
         return self.notification
@@ -1,9 +1,95 @@
 import sqlite3
-from collections import defaultdict
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
 from datetime import date, datetime, timedelta
 import aiosqlite
 import asyncio
 
+from metrics import registry
+
+MAGIC_NUMBER = 1.0 / 59.9 / 1024  # GB-h
+
+DB_SECONDS = registry.histogram('gpustat_db_seconds', 'Duration of the database operations, waiting included.', ['op'])
+
+# applied to every connection; `journal_mode` is persistent and set once in `Database.__init__`
+PRAGMAS = ['PRAGMA synchronous = NORMAL',
+           'PRAGMA mmap_size = 268435456',
+           'PRAGMA cache_size = -65536',
+           'PRAGMA temp_store = MEMORY']
+
+# Compact schema: user names are stored once in `users`, times are integer epochs.
+# The primary keys of the WITHOUT ROWID tables are their covering (time, user_id) indexes.
+SCHEMA = ['''CREATE TABLE IF NOT EXISTS users
+            (id     INTEGER        PRIMARY KEY,
+            name    TEXT           NOT NULL UNIQUE);''',
+          '''CREATE TABLE IF NOT EXISTS samples
+            (time   INTEGER        NOT NULL,
+            user_id INTEGER        NOT NULL,
+            usage   INTEGER        NOT NULL,
+            PRIMARY KEY (time, user_id)) WITHOUT ROWID;''',
+          # hourly totals, maintained by `insert_async`; the raw samples are only read at window edges
+          '''CREATE TABLE IF NOT EXISTS samples_hourly
+            (hour   INTEGER        NOT NULL,
+            user_id INTEGER        NOT NULL,
+            usage   INTEGER        NOT NULL,
+            PRIMARY KEY (hour, user_id)) WITHOUT ROWID;''',
+          # daily totals per local day, maintained by `insert_async` and kept forever
+          '''CREATE TABLE IF NOT EXISTS samples_daily
+            (user_id INTEGER       NOT NULL,
+            day     TEXT           NOT NULL,
+            usage   INTEGER        NOT NULL,
+            PRIMARY KEY (user_id, day)) WITHOUT ROWID;''',
+          # monthly totals of the legacy databases, whose months were compacted by hand, e.g. '2020-05'
+          '''CREATE TABLE IF NOT EXISTS samples_monthly
+            (month  TEXT           NOT NULL,
+            user_id INTEGER        NOT NULL,
+            usage   INTEGER        NOT NULL,
+            PRIMARY KEY (month, user_id)) WITHOUT ROWID;''']
+
+INSERT_USER_SQL = '''
+    INSERT OR IGNORE INTO users (name) VALUES (?);'''
+INSERT_SQL = '''
+    INSERT INTO samples (time, user_id, usage)
+    SELECT ?, id, ? FROM users WHERE name = ?
+    ON CONFLICT (time, user_id) DO UPDATE SET usage = usage + excluded.usage;'''
+INSERT_HOURLY_SQL = '''
+    INSERT INTO samples_hourly (hour, user_id, usage)
+    SELECT ? / 3600 * 3600, id, ? FROM users WHERE name = ?
+    ON CONFLICT (hour, user_id) DO UPDATE SET usage = usage + excluded.usage;'''
+INSERT_DAILY_SQL = '''
+    INSERT INTO samples_daily (day, user_id, usage)
+    SELECT date(?, 'unixepoch', 'localtime'), id, ? FROM users WHERE name = ?
+    ON CONFLICT (user_id, day) DO UPDATE SET usage = usage + excluded.usage;'''
+PAST_SQL = f'''
+    SELECT name, SUM(usage * {MAGIC_NUMBER}) FROM samples
+    JOIN users ON users.id = user_id
+    WHERE time > CAST(strftime('%s', 'now', ?) AS INTEGER)
+    GROUP BY user_id;'''
+# one user's days, read from the (user_id, day) primary key of the daily rollup
+SEARCH_NAME_SQL = f'''
+    SELECT name, day, usage * {MAGIC_NUMBER}
+    FROM samples_daily
+    JOIN users ON users.id = user_id
+    WHERE name = ? AND day >= date('now', 'localtime', '-31 days')
+    ORDER BY day;'''
+GET_ALL_SQL = '''
+    SELECT name, usage, datetime(time, 'unixepoch', 'localtime') FROM samples
+    JOIN users ON users.id = user_id
+    UNION ALL
+    SELECT name, usage, day FROM samples_daily
+    JOIN users ON users.id = user_id
+    WHERE day < (SELECT date(MIN(time), 'unixepoch', 'localtime') FROM samples)
+    UNION ALL
+    SELECT name, usage, month FROM samples_monthly
+    JOIN users ON users.id = user_id;'''
+
+# the top-user windows shown on the page, in seconds
+WINDOWS = {'past1hour': 3600,
+           'past24hours': 24 * 3600,
+           'past3days': 3 * 24 * 3600,
+           'past7days': 7 * 24 * 3600}
+
 
 def get_date_list(today, days=30):
     date = sorted([(datetime.strptime(today, '%Y-%m-%d') - timedelta(days=i)).strftime('%Y-%m-%d')
@@ -11,97 +97,332 @@ def get_date_list(today, days=30):
     return date
 
 
+def migrate(conn):
+    '''Moves the rows of the legacy `usages` table (name, usage, time text) into the compact schema.'''
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+    if 'usages' not in tables:
+        return False
+    with conn:
+        conn.execute('''INSERT OR IGNORE INTO users (name) SELECT DISTINCT name FROM usages;''')
+        conn.execute('''
+            INSERT INTO samples (time, user_id, usage)
+            SELECT CAST(strftime('%s', time, 'utc') AS INTEGER), users.id, SUM(usage) FROM usages
+            JOIN users ON users.name = usages.name
+            WHERE length(time) > 7
+            GROUP BY 1, 2
+            ON CONFLICT (time, user_id) DO UPDATE SET usage = usage + excluded.usage;''')
+        conn.execute('''
+            INSERT INTO samples_monthly (month, user_id, usage)
+            SELECT time, users.id, SUM(usage) FROM usages
+            JOIN users ON users.name = usages.name
+            WHERE length(time) = 7
+            GROUP BY 1, 2
+            ON CONFLICT (month, user_id) DO UPDATE SET usage = usage + excluded.usage;''')
+        conn.execute('''DELETE FROM samples_hourly;''')
+        conn.execute('''
+            INSERT INTO samples_hourly (hour, user_id, usage)
+            SELECT time / 3600 * 3600, user_id, SUM(usage) FROM samples
+            GROUP BY 1, 2;''')
+        conn.execute('''DELETE FROM samples_daily;''')
+        conn.execute('''
+            INSERT INTO samples_daily (day, user_id, usage)
+            SELECT date(time, 'unixepoch', 'localtime'), user_id, SUM(usage) FROM samples
+            GROUP BY 1, 2;''')
+        conn.execute('''DROP TABLE usages;''')
+        conn.execute('''DROP TABLE IF EXISTS usages_hourly;''')
+    # the file is rewritten anyway, see `enable_auto_vacuum`
+    conn.execute('''PRAGMA auto_vacuum = INCREMENTAL;''')
+    conn.execute('''VACUUM;''')
+    return True
+
+
+def enable_auto_vacuum(path):
+    '''Switches an existing database to incremental vacuum, used by `Database.compact_async`.
+    Rewrites the whole file, so it is run once by `db_migrate.py --auto-vacuum`, not on start.
+    '''
+    conn = sqlite3.connect(path)
+    conn.execute('''PRAGMA auto_vacuum = INCREMENTAL;''')
+    conn.execute('''VACUUM;''')
+    conn.close()
+
+
+class UsageBuffer():
+    '''Write-behind buffer of the GPU usage, in MB·minutes per (minute, user) like the `samples` rows.
+
+    Each report of a host adds its usage weighted by the seconds it covers, so short jobs count
+    as long as they ran. The rows are taken for one transaction once `max_rows` are pending or
+    the oldest is `max_age` seconds old. While the writes stall, at most `limit` rows are kept:
+    the oldest minute is then merged into the next one, which keeps the totals but not their time.
+    '''
+
+    def __init__(self, max_rows=1000, max_age=60, limit=100000):
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.limit = limit
+        self.rows = defaultdict(float)
+        self.since = None
+        self.merged = 0
+
+    def add(self, name_usage, t, seconds):
+        '''Adds {name: MB} used during the `seconds` before `t`.'''
+        minute = int(t) // 60 * 60
+        for name, usage in name_usage.items():
+            if usage and seconds > 0:
+                self.rows[(minute, name)] += usage * seconds / 60
+        if self.rows and self.since is None:
+            self.since = time.time()
+        while len(self.rows) > self.limit and self.merge_oldest():
+            pass
+
+    def merge_oldest(self):
+        minutes = sorted(set(minute for minute, _ in self.rows))
+        if len(minutes) < 2:
+            return False
+        for (minute, name) in [key for key in self.rows if key[0] == minutes[0]]:
+            self.rows[(minutes[1], name)] += self.rows.pop((minute, name))
+        self.merged += 1
+        return True
+
+    def is_due(self):
+        return bool(self.rows) and (len(self.rows) >= self.max_rows or time.time() - self.since >= self.max_age)
+
+    def take(self):
+        '''Returns the pending rows as [(name, MB·minutes, time)] and empties the buffer.'''
+        rows = [(name, round(usage), minute) for (minute, name), usage in sorted(self.rows.items())]
+        self.rows = defaultdict(float)
+        self.since = None
+        return [row for row in rows if row[1] > 0]
+
+    def put_back(self, rows):
+        '''Keeps the rows of a failed write for the next one.'''
+        for name, usage, minute in rows:
+            self.rows[(minute, name)] += usage
+        if self.rows and self.since is None:
+            self.since = time.time()
+        while len(self.rows) > self.limit and self.merge_oldest():
+            pass
+
+
 class Database():
-    def __init__(self, path='usages.db'):
+    '''The usage database.
+
+    Connections are long-lived: one writer, whose transactions are serialized,
+    and a pool of up to `readers` read-only connections. In WAL mode the readers
+    never block the writer. Statements are cached per connection by sqlite3,
+    so the SQL texts are kept constant and parameterized.
+    '''
+
+    def __init__(self, path='usages.db', readers=2, report_cache_size=256):
         self.path = path
+        self.readers = readers
+        # LRU of the per-user reports, entries are dropped when the user is written
+        self.report_cache = OrderedDict()
+        self.report_cache_size = report_cache_size
+        self.report_generation = 0
+        self._writer = None
+        self._write_lock = None
+        self._reader_pool = None
+        self._reader_count = 0
+        self._sync_conn = None
+
         conn = sqlite3.connect(self.path)
         cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS usages
-            (name   VARCHAR(20)    NOT NULL,
-            usage   INT            NOT NULL,
-            time    DATETIME       NOT NULL);''')
-        cursor.execute('''DROP INDEX IF EXISTS name_index;''')
-        cursor.execute('''DROP INDEX IF EXISTS time_index;''')
+        # free pages are given back by `compact_async` in small steps, instead of a full VACUUM
+        tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+        if cursor.execute('''PRAGMA auto_vacuum;''').fetchone()[0] != 2:
+            if not tables:
+                # takes effect without a VACUUM on a new file
+                cursor.execute('''PRAGMA auto_vacuum = INCREMENTAL;''')
+            elif 'usages' not in tables:
+                # a legacy database is switched by `migrate` below
+                print(f'{path} does not give back its free pages: run `python db_migrate.py --auto-vacuum {path}` '
+                      'once, with the server stopped.')
+        cursor.execute('''PRAGMA journal_mode = WAL;''')
+        for sql in SCHEMA:
+            cursor.execute(sql)
+        if cursor.execute('''SELECT COUNT(*) FROM samples_daily;''').fetchone()[0] == 0:
+            cursor.execute('''
+                INSERT INTO samples_daily (day, user_id, usage)
+                SELECT date(hour, 'unixepoch', 'localtime'), user_id, SUM(usage) FROM samples_hourly
+                GROUP BY 1, 2;''')
         conn.commit()
         cursor.close()
+        if migrate(conn):
+            print('Migrated the usages table to the compact schema.')
         conn.close()
 
-    async def clear_async(self, month_like):
-        print('=' * 20, month_like, '=' * 20)
-        db = await aiosqlite.connect(self.path)
-        cursor = await db.execute(f'''
-                    SELECT name, SUM(usage) FROM usages
-                    WHERE time LIKE '{month_like}_%'
-                    GROUP BY name;
-                    ''')
-        rows = await cursor.fetchall()
-        print('Rows to be deleted:', rows)
-        await cursor.close()
-        await db.close()
-
-        p = [(name, usage, month_like) for name, usage in rows if int(usage) > 0]
-        self.insert(p, auto_time=False)
-
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(f'''
-                        DELETE FROM usages
-                        WHERE time LIKE '{month_like}_%_%'
-                        ''')
-            await db.commit()
-
-        db = await aiosqlite.connect(self.path)
-        cursor = await db.execute(f'''
-                    SELECT * FROM usages
-                    WHERE time LIKE '{month_like}%'
-                    ''')
-        rows = await cursor.fetchall()
-        print('Now exsiting:', rows)
-        await cursor.close()
-        await db.close()
-
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute('''vacuum;''')
-            await db.commit()
+    async def _connect(self, read_only=False):
+        db = await aiosqlite.connect(self.path, cached_statements=256)
+        for pragma in PRAGMAS:
+            await db.execute(pragma)
+        if read_only:
+            await db.execute('PRAGMA query_only = ON')
+        return db
 
+    @asynccontextmanager
+    async def write(self):
+        '''Borrows the writer connection. The transaction is committed on exit, or rolled back on error.'''
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            if self._writer is None:
+                self._writer = await self._connect()
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    @asynccontextmanager
+    async def read(self):
+        '''Borrows a read-only connection from the pool.'''
+        if self._reader_pool is None:
+            self._reader_pool = asyncio.Queue()
+        if self._reader_pool.empty() and self._reader_count < self.readers:
+            self._reader_count += 1
+            try:
+                db = await self._connect(read_only=True)
+            except Exception:
+                self._reader_count -= 1
+                raise
+        else:
+            db = await self._reader_pool.get()
+        try:
+            yield db
+        finally:
+            self._reader_pool.put_nowait(db)
+
+    async def fetchall_async(self, sql, params=(), op='read'):
+        with DB_SECONDS.time(op=op):
+            async with self.read() as db:
+                cursor = await db.execute(sql, params)
+                rows = await cursor.fetchall()
+                await cursor.close()
         return rows
 
-    def clear(self, months=['2020-05']):
-        for month in months:
-            asyncio.run(self.clear_async(month))
+    async def close_async(self):
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+        while self._reader_pool is not None and not self._reader_pool.empty():
+            await self._reader_pool.get_nowait().close()
+            self._reader_count -= 1
+
+    def sync_conn(self):
+        '''The connection of the synchronous helpers, kept open as well.'''
+        if self._sync_conn is None:
+            self._sync_conn = sqlite3.connect(self.path, cached_statements=256)
+            for pragma in PRAGMAS:
+                self._sync_conn.execute(pragma)
+        return self._sync_conn
+
+    async def expire_async(self, table, column, before, step, pause=0.05):
+        '''Deletes the rows of `table` older than `before`, `step` seconds of them per transaction.'''
+        deleted = 0
+        while True:
+            rows = await self.fetchall_async(f'SELECT MIN({column}) FROM {table};')
+            first = rows[0][0]
+            if first is None or first >= before:
+                return deleted
+            async with self.write() as db:
+                cursor = await db.execute(f'DELETE FROM {table} WHERE {column} < ?;',
+                                          (min(before, first + step),))
+                deleted += cursor.rowcount
+            # let the live writes in between the batches
+            await asyncio.sleep(pause)
+
+    async def vacuum_async(self, pages=256, pause=0.05):
+        '''Gives the free pages back to the file system, `pages` per step.'''
+        while True:
+            freelist = (await self.fetchall_async('PRAGMA freelist_count;'))[0][0]
+            if freelist == 0:
+                return
+            async with self.write() as db:
+                await db.executescript(f'PRAGMA incremental_vacuum({pages});')
+            await asyncio.sleep(pause)
+
+    async def compact_async(self, raw_retention=8 * 86400, hourly_retention=90 * 86400, pause=0.05):
+        '''Expires the raw samples and the hourly rollups, then vacuums incrementally.
+
+        The rollups are maintained on insert, so nothing is lost: the top-user windows need
+        the hourly rollups of the past 7 days and the raw samples of their first partial hour,
+        the 31-day report the daily rollups.
+        Returns the deleted (raw, hourly) row counts.
+        '''
+        now = int(time.time())
+        with DB_SECONDS.time(op='compact'):
+            raw = await self.expire_async('samples', 'time', now - raw_retention, step=3600, pause=pause)
+            hourly = await self.expire_async('samples_hourly', 'hour', now - hourly_retention, step=86400, pause=pause)
+            await self.vacuum_async(pause=pause)
+        return raw, hourly
+
+    @staticmethod
+    def get_insert_params(name_usage_list, auto_time=True):
+        '''Returns [(time, usage, name)]. Without `auto_time`, the items are (name, usage, epoch).'''
+        if auto_time:
+            now = int(time.time())
+            return [(now, usage, name) for name, usage in name_usage_list]
+        return [(int(t), usage, name) for name, usage, t in name_usage_list]
 
     async def insert_async(self, name_usage_list=[('test', 1)], auto_time=True):
-        async with aiosqlite.connect(self.path) as db:
-            if auto_time:
-                await db.executemany('''
-                    INSERT INTO USAGES (NAME, USAGE, TIME)
-                    VALUES (?, ?, datetime('now', 'localtime'));''', name_usage_list)
-            else:
-                await db.executemany('''
-                    INSERT INTO USAGES (NAME, USAGE, TIME)
-                    VALUES (?, ?, ?);''', name_usage_list)
-            await db.commit()
+        params = self.get_insert_params(name_usage_list, auto_time)
+        with DB_SECONDS.time(op='insert'):
+            async with self.write() as db:
+                await db.executemany(INSERT_USER_SQL, [(name,) for _, _, name in params])
+                await db.executemany(INSERT_SQL, params)
+                await db.executemany(INSERT_HOURLY_SQL, params)
+                await db.executemany(INSERT_DAILY_SQL, params)
+        self.invalidate_reports(name for _, _, name in params)
 
     def insert(self, name_usage_list=[('user_test', 1)], auto_time=True):
-        asyncio.run(self.insert_async(name_usage_list,
-                                      auto_time=auto_time))
+        params = self.get_insert_params(name_usage_list, auto_time)
+        conn = self.sync_conn()
+        with conn:
+            conn.executemany(INSERT_USER_SQL, [(name,) for _, _, name in params])
+            conn.executemany(INSERT_SQL, params)
+            conn.executemany(INSERT_HOURLY_SQL, params)
+            conn.executemany(INSERT_DAILY_SQL, params)
+        self.invalidate_reports(name for _, _, name in params)
         print('inserted!')
 
     async def past_async(self, last_what='-7 days'):
-        magic_number = 1.0 / 59.9 / 1024  # GB-h
-        db = await aiosqlite.connect(self.path)
-        cursor = await db.execute(f'''
-                    SELECT name, SUM(usage * {magic_number}  ) FROM usages
-                    WHERE time > datetime('now', '{last_what}', 'localtime')
-                    GROUP BY name;
-                    ''')
-        rows = await cursor.fetchall()
-        await cursor.close()
-        await db.close()
-        return rows
+        return await self.fetchall_async(PAST_SQL, (last_what,), op='past')
+
+    async def past_windows_async(self, windows=WINDOWS):
+        '''Returns {window: [(user, usage)]} in GB-h for all the windows, in one pass.
+
+        Whole hours are summed from `samples_hourly`, and the partial hour at the
+        start of each window from the raw samples.
+        '''
+        now = int(time.time())
+        starts = [now - seconds for seconds in windows.values()]
+        # window k covers the raw samples in (start_k, edge_k) and the hourly rows from edge_k on
+        edges = [(start // 3600 + 1) * 3600 for start in starts]
+        columns = ', '.join(f'''SUM(CASE WHEN (src = 'h' AND t >= ?) OR (src = 'r' AND t > ? AND t < ?)
+                                THEN usage ELSE 0 END) * {MAGIC_NUMBER}''' for _ in windows)
+        raw_ranges = ' OR '.join('(time > ? AND time < ?)' for _ in windows)
+        params = []
+        for start, edge in zip(starts, edges):
+            params += [edge, start, edge]
+        params.append(min(edges))
+        for start, edge in zip(starts, edges):
+            params += [start, edge]
+        rows = await self.fetchall_async(f'''
+                    SELECT name, {columns} FROM (
+                        SELECT 'h' AS src, user_id, hour AS t, usage FROM samples_hourly WHERE hour >= ?
+                        UNION ALL
+                        SELECT 'r' AS src, user_id, time AS t, usage FROM samples WHERE {raw_ranges}
+                    )
+                    JOIN users ON users.id = user_id
+                    GROUP BY user_id;
+                    ''', params, op='past_windows')
+        return {window: [(row[0], row[i + 1]) for row in rows if row[i + 1] > 0]
+                for i, window in enumerate(windows)}
 
     def past(self, last_what='-7 days'):
         '''Returns [(user, usage)] in GB-h.'''
-        return asyncio.run(self.past_async(last_what))
+        return self.sync_conn().execute(PAST_SQL, (last_what,)).fetchall()
 
     def past_1_hour(self):
         return self.past('-1 hour')
@@ -116,32 +437,45 @@ class Database():
         return self.past('-7 days')
 
     def get_all(self):
-        conn = sqlite3.connect(self.path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT name, usage, time FROM usages;
-            ''')
-        values = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return values
+        return self.sync_conn().execute(GET_ALL_SQL).fetchall()
 
     async def search_name_async(self, user):
         """Search the monthly report."""
-        magic_number = 1.0 / 59.9 / 1024  # GB-h
-        db = await aiosqlite.connect(self.path)
-        cursor = await db.execute(f'''
-                SELECT name, date(time), sum(usage * {magic_number} )
-                FROM usages
-                WHERE name = ? AND time > datetime("now", "-31 days")
-                GROUP BY name, date(time);''', (user.strip(),))
-        rows = await cursor.fetchall()
-        await cursor.close()
-        await db.close()
-        return rows
+        return await self.fetchall_async(SEARCH_NAME_SQL, (user.strip(),), op='search_name')
 
     def search_name(self, user):
-        return asyncio.run(self.search_name(user))
+        return self.sync_conn().execute(SEARCH_NAME_SQL, (user.strip(),)).fetchall()
+
+    def invalidate_reports(self, users):
+        self.report_generation += 1
+        for user in users:
+            self.report_cache.pop(user, None)
+
+    async def report_async(self, user, days=31):
+        '''Returns [(day, usage)] in GB-h of the last `days` days up to today, cached until the user is written.'''
+        user = user.strip()
+        key = (user, days, str(date.today()))
+        cached = self.report_cache.get(user)
+        if cached is not None and cached[0] == key:
+            self.report_cache.move_to_end(user)
+            return cached[1]
+
+        generation = self.report_generation
+        raw = await self.search_name_async(user)
+        res = defaultdict(float)
+        for (_, d, usage) in raw:
+            res[d] = usage
+        tomorrow = str(date.today() + timedelta(days=1))
+        report = [(d, res[d]) for d in get_date_list(tomorrow, days=days)]
+
+        if generation != self.report_generation:
+            # written while reading, the report may already be stale
+            return report
+        self.report_cache[user] = (key, report)
+        self.report_cache.move_to_end(user)
+        while len(self.report_cache) > self.report_cache_size:
+            self.report_cache.popitem(last=False)
+        return report
 
     def summary(self, user):
         raw = self.search_name(user.strip())
@@ -155,8 +489,11 @@ class Database():
 
 
 if __name__ == "__main__":
-    import time
     t = time.time()
     db = Database()
-    db.clear([f'2020-{m:02d}' for m in range(4, 8)])
+
+    async def _compact():
+        print('Deleted (raw, hourly) rows:', await db.compact_async())
+        await db.close_async()
+    asyncio.run(_compact())
     print(time.time() - t)
@@ -0,0 +1,140 @@
+"""
+Migrates a copy of a legacy usage database to the compact schema of `db.py`,
+and compares the file size and the query latency before/after.
+
+    python db_migrate.py usages.db
+    python db_migrate.py --fake 1000000   # a synthetic legacy database
+    python db_migrate.py --auto-vacuum usages.db   # in place, with the server stopped
+
+The original file is not modified, except by `--auto-vacuum`, which rewrites it once to switch
+a database created before the incremental vacuum. `Database` migrates a legacy file by itself on start.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from db import MAGIC_NUMBER, Database, enable_auto_vacuum
+
+LEGACY_PAST_SQL = f'''
+    SELECT name, SUM(usage * {MAGIC_NUMBER}) FROM usages
+    WHERE time > datetime('now', ?, 'localtime')
+    GROUP BY name;'''
+LEGACY_SEARCH_NAME_SQL = f'''
+    SELECT name, date(time), sum(usage * {MAGIC_NUMBER})
+    FROM usages
+    WHERE name = ? AND time > datetime("now", "-31 days")
+    GROUP BY name, date(time);'''
+LEGACY_WINDOWS = ['-1 hour', '-24 hours', '-3 days', '-7 days']
+
+
+def make_fake(path, rows, users=50, interval=60):
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE usages
+            (name   VARCHAR(20)    NOT NULL,
+            usage   INT            NOT NULL,
+            time    DATETIME       NOT NULL);''')
+    names = [f'user{i:03d}' for i in range(users)]
+    now = datetime.now()
+    batch = []
+    for i in range(rows):
+        t = now - timedelta(seconds=interval * (i // users))
+        batch.append((names[i % users], random.randint(1, 11178), t.strftime('%Y-%m-%d %H:%M:%S')))
+        if len(batch) >= 100000:
+            conn.executemany('INSERT INTO usages VALUES (?, ?, ?)', batch)
+            batch = []
+    conn.executemany('INSERT INTO usages VALUES (?, ?, ?)', batch)
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+
+
+def timed(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_legacy(path, user):
+    conn = sqlite3.connect(path)
+    windows = timed(lambda: [conn.execute(LEGACY_PAST_SQL, (w,)).fetchall() for w in LEGACY_WINDOWS])
+    search = timed(lambda: conn.execute(LEGACY_SEARCH_NAME_SQL, (user,)).fetchall())
+    conn.close()
+    return windows, search
+
+
+def bench_compact(path, user):
+    db = Database(path)
+
+    async def _windows():
+        return await db.past_windows_async()
+
+    async def _run():
+        loop = asyncio.get_running_loop()
+        best = float('inf')
+        for _ in range(5):
+            start = loop.time()
+            await _windows()
+            best = min(best, loop.time() - start)
+        await db.close_async()
+        return best
+
+    windows = asyncio.run(_run())
+    search = timed(lambda: db.search_name(user))
+    return windows, search
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', default='usages.db')
+    parser.add_argument('--fake', type=int, default=0, help='generate a legacy database of this many rows')
+    parser.add_argument('--user', default=None, help='user of the 31-day report query')
+    parser.add_argument('--auto-vacuum', action='store_true', help='switch `path` to incremental vacuum, in place')
+    args = parser.parse_args()
+
+    if args.auto_vacuum:
+        size = os.path.getsize(args.path)
+        start = time.perf_counter()
+        enable_auto_vacuum(args.path)
+        print(f'{args.path}: {size / 2 ** 20:.2f} MB -> {os.path.getsize(args.path) / 2 ** 20:.2f} MB '
+              f'in {time.perf_counter() - start:.2f}s')
+        return
+
+    workdir = tempfile.mkdtemp()
+    legacy = os.path.join(workdir, 'legacy.db')
+    compact = os.path.join(workdir, 'compact.db')
+    if args.fake:
+        make_fake(legacy, args.fake)
+    else:
+        shutil.copy(args.path, legacy)
+    shutil.copy(legacy, compact)
+    user = args.user or sqlite3.connect(legacy).execute('SELECT name FROM usages LIMIT 1').fetchone()[0]
+
+    legacy_size = os.path.getsize(legacy)
+    legacy_windows, legacy_search = bench_legacy(legacy, user)
+
+    start = time.perf_counter()
+    Database(compact)  # migrates
+    migrate_time = time.perf_counter() - start
+    compact_size = os.path.getsize(compact)
+    compact_windows, compact_search = bench_compact(compact, user)
+
+    print(f"{'':<24} {'legacy':>12} {'compact':>12}")
+    print(f"{'file size (MB)':<24} {legacy_size / 2 ** 20:>12.2f} {compact_size / 2 ** 20:>12.2f}")
+    print(f"{'4 top-user windows (ms)':<24} {legacy_windows * 1000:>12.2f} {compact_windows * 1000:>12.2f}")
+    print(f"{'31-day report (ms)':<24} {legacy_search * 1000:>12.2f} {compact_search * 1000:>12.2f}")
+    print(f"migration took {migrate_time:.2f}s")
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
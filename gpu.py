@@ -0,0 +1,91 @@
+import json
+from collections import defaultdict, namedtuple
+
+from termcolor import colored
+
+GPU = namedtuple('GPU', ['index', 'name', 'temperature', 'utilization', 'power_draw', 'power_limit',
+                         'memory_used', 'memory_total', 'processes'])
+GPUProcess = namedtuple('GPUProcess', ['username', 'pid', 'command', 'gpu_memory_usage'])
+GPUStat = namedtuple('GPUStat', ['hostname', 'driver_version', 'gpus'],
+                     defaults=['', '', ()])
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def parse_gpustat_json(text):
+    '''Parses the output of `gpustat --json` into typed records.'''
+    raw = json.loads(text)
+    gpus = []
+    for gpu in raw.get('gpus', []):
+        processes = tuple(GPUProcess(username=p.get('username') or '?',
+                                     pid=_int(p.get('pid')),
+                                     command=p.get('command') or '',
+                                     gpu_memory_usage=_int(p.get('gpu_memory_usage')))
+                          for p in gpu.get('processes') or [])
+        gpus.append(GPU(index=_int(gpu.get('index')),
+                        name=gpu.get('name', ''),
+                        temperature=_int(gpu.get('temperature.gpu')),
+                        utilization=_int(gpu.get('utilization.gpu')),
+                        power_draw=_int(gpu.get('power.draw')),
+                        power_limit=_int(gpu.get('enforced.power.limit')),
+                        memory_used=_int(gpu.get('memory.used')),
+                        memory_total=_int(gpu.get('memory.total')),
+                        processes=processes))
+    return GPUStat(hostname=raw.get('hostname', ''), driver_version=raw.get('driver_version', ''),
+                   gpus=tuple(gpus))
+
+
+def short_gpu_name(name):
+    for prefix in ['NVIDIA ', 'GeForce GTX ', 'GeForce ']:
+        name = name.replace(prefix, '')
+    return name
+
+
+def format_gpu(gpu, name_width=10):
+    '''Formats one GPU in the colors of gpustat. The user/usage spans are read by the page.'''
+    processes = ' '.join('\033[1;30m{}\033[0m(\033[33m{}M\033[0m)'.format(p.username, p.gpu_memory_usage)
+                         for p in gpu.processes)
+    return (colored(f'[{gpu.index}]', 'cyan') +
+            ' \033[1;33m{:>5}\033[0m / \033[33m{:>5}\033[0m MB |'.format(gpu.memory_used, gpu.memory_total) +
+            ' \033[34m{}\033[0m'.format(short_gpu_name(gpu.name)[:name_width].ljust(name_width)) +
+            ' \033[31m{:>3}\'C\033[0m \033[32m{:>3} %\033[0m'.format(gpu.temperature, gpu.utilization) +
+            ' \033[35m{:>3}W\033[0m |'.format(gpu.power_draw) +
+            (' ' + processes if processes else ''))
+
+
+def format_gpus(gpus):
+    return '\n'.join(format_gpu(gpu) for gpu in gpus)
+
+
+def get_gpu_fields(gpus):
+    '''Compact rows of the GPUs for the web client:
+    [index, short name, temperature, utilization, power draw, memory used, memory total, [[username, MB], ...]].
+    '''
+    return [[gpu.index, short_gpu_name(gpu.name), gpu.temperature, gpu.utilization, gpu.power_draw,
+             gpu.memory_used, gpu.memory_total, [[p.username, p.gpu_memory_usage] for p in gpu.processes]]
+            for gpu in gpus]
+
+
+def get_name_usage(gpus):
+    '''Returns {username: GPU memory in MB}.'''
+    name_usage_dict = defaultdict(int)
+    for gpu in gpus:
+        for p in gpu.processes:
+            name_usage_dict[p.username] += p.gpu_memory_usage
+    return name_usage_dict
+
+
+def get_gpu_metrics(gpus):
+    '''Returns the numeric metrics of the GPUs, e.g. {'gpu0.util': 87}.'''
+    metrics = {}
+    for gpu in gpus:
+        metrics[f'gpu{gpu.index}.util'] = gpu.utilization
+        metrics[f'gpu{gpu.index}.mem'] = gpu.memory_used
+        metrics[f'gpu{gpu.index}.temp'] = gpu.temperature
+        metrics[f'gpu{gpu.index}.power'] = gpu.power_draw
+    return metrics
@@ -0,0 +1,172 @@
+'''
+Self-metrics of the server: counters, gauges and histograms, served by
+`/metrics` in the Prometheus text format, or as json with `?format=json`.
+'''
+
+import math
+import time
+from contextlib import contextmanager
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric():
+    type = ''
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def get_key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def get_labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def items(self):
+        return sorted(self.values.items())
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self.get_key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    '''Read when collected: `func()` returns [(labels, value)].'''
+    type = 'gauge'
+
+    def __init__(self, name, doc, labelnames=(), func=None):
+        super().__init__(name, doc, labelnames)
+        self.func = func
+
+    def items(self):
+        return sorted((self.get_key(labels), value) for labels, value in self.func())
+
+
+class HistogramValue():
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        if key not in self.values:
+            self.values[key] = HistogramValue(self.buckets)
+        hist = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                hist.counts[i] += 1
+                break
+        else:
+            hist.counts[-1] += 1
+        hist.sum += value
+        hist.count += 1
+        hist.max = max(hist.max, value)
+
+    @contextmanager
+    def time(self, **labels):
+        '''Observes the seconds spent in the block, even if it raises.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, hist, q):
+        '''Upper bound of the bucket holding the `q` quantile.'''
+        rank = q * hist.count
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), hist.counts):
+            total += count
+            if total >= rank:
+                return min(bound, hist.max)
+        return hist.max
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                          for k, v in labels.items()) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self.register(Counter(name, doc, labelnames))
+
+    def gauge(self, name, doc, labelnames=(), func=None):
+        return self.register(Gauge(name, doc, labelnames, func))
+
+    def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, doc, labelnames, buckets))
+
+    def render_text(self):
+        '''The Prometheus text exposition format.'''
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.doc}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for key, value in metric.items():
+                labels = metric.get_labels(key)
+                if metric.type != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+                    continue
+                total = 0
+                for bound, count in zip(metric.buckets + (math.inf,), value.counts):
+                    total += count
+                    lines.append(f'{name}_bucket{format_labels(labels, le=format_value(bound))} {total}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(value.sum)}')
+                lines.append(f'{name}_count{format_labels(labels)} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        '''A json-friendly summary, with the mean, max and approximate quantiles of the histograms.'''
+        result = {}
+        for name, metric in sorted(self.metrics.items()):
+            samples = []
+            for key, value in metric.items():
+                sample = {'labels': metric.get_labels(key)}
+                if metric.type == 'histogram':
+                    sample.update(count=value.count, sum=round(value.sum, 6),
+                                  mean=round(value.sum / value.count, 6) if value.count else None,
+                                  p50=round(metric.quantile(value, 0.5), 6), p95=round(metric.quantile(value, 0.95), 6),
+                                  max=round(value.max, 6))
+                else:
+                    sample['value'] = value
+                samples.append(sample)
+            result[name] = {'type': metric.type, 'help': metric.doc, 'samples': samples}
+        return result
+
+
+registry = Registry()
@@ -0,0 +1,318 @@
+import asyncio
+import hashlib
+import json
+import threading
+import traceback
+from collections import OrderedDict, namedtuple
+
+import ansi2html
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from metrics import registry
+from utils import cprint, escape_ansi, msg_from_host, now_time
+
+RENDER_SECONDS = registry.histogram('gpustat_render_seconds', 'Duration of rendering one payload or frame.', ['kind'])
+ANSI_SECONDS = registry.histogram('gpustat_ansi_convert_seconds', 'Duration of one ANSI to HTML conversion.', ['where'])
+ANSI_MEMO = registry.counter('gpustat_ansi_memo_total', 'Lookups of converted blocks in the memo.', ['result'])
+
+scheme = 'solarized'
+ansi2html.style.SCHEME[scheme] = list(ansi2html.style.SCHEME[scheme])
+ansi2html.style.SCHEME[scheme][0] = '#555555'
+
+SECTIONS = ['disk', 'notification', 'top_users', 'network']
+
+# the hosts shown to a client: `hosts` (lowercase names, None for all), and only the ones with a free GPU
+# if `free_only`. The view None shows everything.
+View = namedtuple('View', ['hosts', 'free_only'], defaults=[None, False])
+
+ENCODINGS = ['json', 'msgpack'] if msgpack is not None else ['json']
+
+_local = threading.local()
+
+
+def encode(frame, encoding='json'):
+    '''Serializes a frame: json text, or msgpack bytes (needs the optional `msgpack` package).'''
+    if encoding == 'msgpack':
+        return msgpack.packb(frame, use_bin_type=True)
+    return json.dumps(frame, ensure_ascii=False, separators=(',', ':'))
+
+
+def convert_ansi(text):
+    '''ANSI to HTML. Runs in the render pool, with one converter per thread (or process).'''
+    if not hasattr(_local, 'converter'):
+        _local.converter = ansi2html.Ansi2HTMLConverter(dark_bg=True, scheme=scheme)
+    return _local.converter.convert(text, full=False)
+
+
+class Renderer():
+    '''Renders the context into json payloads.
+
+    Every section (one per remote host, plus disk/notification/top_users/network)
+    is rendered at most once per change of that section, and shared by the full
+    payload of the poll protocol and the delta frames.
+
+    The ANSI to HTML conversion runs off the event loop, in `executor` (None is
+    the loop's default thread pool), and is memoized by the hash of the text,
+    so that only the blocks whose text changed are converted again. A block
+    being converted is awaited by the other callers instead of converted twice.
+
+    Payloads are rendered per `View`, so that a client watching a few hosts
+    only gets (and only makes the server convert) those hosts.
+    '''
+
+    def __init__(self, context, hosts, executor=None, memo_size=1024, free_memory=1000, checked_interval=2):
+        self.context = context
+        self.hosts = hosts
+        self.free_memory = free_memory
+        self.ansi_conv = ansi2html.Ansi2HTMLConverter(dark_bg=True, scheme=scheme)
+        self.section_cache = {}
+        self.body_cache = {'version': None, 'body': {}}
+        self.executor = executor
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        # key -> the future of the block being converted in `executor`
+        self.converting = {}
+        self.listeners = []
+        # if set, returns the views someone is waiting html for, so only those are converted ahead of time
+        self.html_views = None
+        # the hosts only checked, not changed, are pushed at most every `checked_interval` seconds
+        self.checked_interval = checked_interval
+        self.checked_handle = None
+        self.last_notified = 0.0
+
+    def add_listener(self, func):
+        '''`func(version)` is called once the changed sections are rendered.'''
+        self.listeners.append(func)
+
+    async def run(self, events):
+        '''Renders the changed sections in the background as the events of the context arrive,
+        then calls the listeners. The changes made meanwhile are coalesced into the next pass.
+        '''
+        loop = asyncio.get_running_loop()
+        async for batch in events:
+            if any(event.changed for event in batch):
+                try:
+                    await self.refresh()
+                except Exception as ex:
+                    # the next changes are rendered anyway, the stale sections again with them
+                    msg_from_host('RENDER', f"{type(ex).__name__}: {ex}", color='red')
+                    cprint(traceback.format_exc())
+            elif self.checked_handle is None:
+                # nothing to render, only the freshness of the hosts
+                delay = max(0.0, self.last_notified + self.checked_interval - loop.time())
+                self.checked_handle = loop.call_later(delay, self.notify_checked)
+
+    def notify_checked(self):
+        self.checked_handle = None
+        self.notify()
+
+    def notify(self):
+        self.last_notified = asyncio.get_running_loop().time()
+        for func in self.listeners:
+            func(self.context.version)
+
+    async def refresh(self):
+        views = None if self.html_views is None else self.html_views()
+        if views is None:
+            await self.prepare()
+        else:
+            for view in views:
+                await self.prepare(view)
+        self.notify()
+
+    def get_memo(self, text):
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        html = self.memo.get(key)
+        if html is not None:
+            self.memo.move_to_end(key)
+        ANSI_MEMO.inc(result='hit' if html is not None else 'in_flight' if key in self.converting else 'miss')
+        return key, html
+
+    def set_memo(self, key, html):
+        self.memo[key] = html
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+
+    def convert(self, text):
+        if not text:
+            return ''
+        key, html = self.get_memo(text)
+        if html is None:
+            with ANSI_SECONDS.time(where='loop'):
+                html = convert_ansi(text)
+            self.set_memo(key, html)
+        return html
+
+    async def convert_async(self, text):
+        if not text:
+            return ''
+        key, html = self.get_memo(text)
+        if html is not None:
+            return html
+        future = self.converting.get(key)
+        if future is None:
+            future = self.converting[key] = asyncio.ensure_future(self.convert_pooled(key, text))
+            future.add_done_callback(lambda _: self.converting.pop(key, None))
+        # a cancelled caller does not cancel the conversion awaited by the others
+        return await asyncio.shield(future)
+
+    async def convert_pooled(self, key, text):
+        with ANSI_SECONDS.time(where='pool'):
+            html = await asyncio.get_running_loop().run_in_executor(self.executor, convert_ansi, text)
+        self.set_memo(key, html)
+        return html
+
+    def get_hosts(self, view=None):
+        '''The hosts of `view`, in the configured order.'''
+        if view is None:
+            return self.hosts
+        hosts = [host for host in self.hosts if view.hosts is None or host.lower() in view.hosts]
+        if view.free_only:
+            hosts = [host for host in hosts if self.context.count_free_gpus(host, self.free_memory)]
+        return hosts
+
+    def all_sections(self, view=None):
+        return [('remote', host) for host in self.get_hosts(view)] + SECTIONS
+
+    async def prepare(self, view=None):
+        '''Renders the sections changed since their last rendering, converting them off the event loop.'''
+        await asyncio.gather(*[self.prepare_section(section) for section in self.all_sections(view)
+                               if self.is_stale(section)])
+
+    async def prepare_section(self, section):
+        version = self.context.get_section_version(section)
+        ansi, plain = self._section_fields(section)
+        htmls = await asyncio.gather(*[self.convert_async(text) for text in ansi.values()])
+        cached = self.section_cache.get(section)
+        if cached is None or cached[0] < version:
+            self.section_cache[section] = (version, self._build_section(section, dict(zip(ansi, htmls)), plain))
+
+    def is_stale(self, section):
+        cached = self.section_cache.get(section)
+        return cached is None or cached[0] != self.context.get_section_version(section)
+
+    def produce_headers(self):
+        return self.ansi_conv.produce_headers()
+
+    def render_section(self, section):
+        '''Returns the rendered section, converting it on the spot if `prepare` did not yet.'''
+        if self.is_stale(section):
+            version = self.context.get_section_version(section)
+            ansi, plain = self._section_fields(section)
+            htmls = {field: self.convert(text) for field, text in ansi.items()}
+            self.section_cache[section] = (version, self._build_section(section, htmls, plain))
+        return self.section_cache[section][1]
+
+    def _section_fields(self, section):
+        '''Returns ({field: ANSI text to convert}, {field: plain value}) of a section.'''
+        context = self.context
+        if isinstance(section, tuple) and section[0] == 'remote':
+            return {'html': context.get_remote_status(section[1])}, {}
+
+        if section == 'disk':
+            disk_usage, disk_usage_time = context.get_disk_status()
+            return {'disk_status': disk_usage}, {'disk_status_time': now_time(disk_usage_time)}
+        elif section == 'notification':
+            return {'notification': context.get_notification()}, {}
+        elif section == 'top_users':
+            status, status_time, status_comment = context.get_top_users_status()
+            return ({'top_users_status_comment': status_comment},
+                    {'top_users_status': status, 'top_users_status_time': now_time(status_time)})
+        elif section == 'network':
+            status, status_time = context.get_all_network_status()
+            return {'network_status': status}, {'network_status_time': now_time(status_time)}
+        raise KeyError(f'Unknown section: {section}')
+
+    @staticmethod
+    def _build_section(section, htmls, plain):
+        if isinstance(section, tuple) and section[0] == 'remote':
+            return htmls['html']
+        return dict(plain, **htmls)
+
+    def render_body(self, encoding='json', view=None):
+        '''Returns the full payload of the poll protocol, rebuilt at most once per context version, encoding and view.'''
+        version = self.context.version
+        if self.body_cache['version'] != version:
+            self.body_cache['body'] = {}
+            self.body_cache['version'] = version
+        key = (encoding, view)
+        if key not in self.body_cache['body']:
+            with RENDER_SECONDS.time(kind='body'):
+                results = {'remote_status': ''.join(self.render_section(('remote', host))
+                                                    for host in self.get_hosts(view))}
+                for section in SECTIONS:
+                    results.update(self.render_section(section))
+                self.body_cache['body'][key] = encode(results, encoding)
+        return self.body_cache['body'][key]
+
+    def get_checked_at(self, hosts):
+        '''When each host was last polled, changed or not. Sent apart from the rendered hosts,
+        which are only rebuilt when they change.
+        '''
+        remote_status = self.context.get_all_remote_status()
+        return {host: now_time(remote_status[host].update_time, simple=True)
+                for host in hosts if host in remote_status}
+
+    def render_delta(self, since=None, encoding='json', view=None):
+        '''Returns a frame with the hosts and sections changed after version `since`.
+
+        A full frame is returned when `since` is None or unknown to the server (e.g. it restarted).
+        '''
+        with RENDER_SECONDS.time(kind='delta'):
+            version = self.context.version
+            hosts = self.get_hosts(view)
+            if since is None or since > version:
+                frame = {'type': 'full', 'base': None}
+                changed = set([('remote', host) for host in hosts] + SECTIONS)
+            else:
+                frame = {'type': 'delta', 'base': since}
+                changed = set(self.context.changed_sections(since))
+            frame['version'] = version
+            frame['host_order'] = hosts
+            frame['hosts'] = {host: self.render_section(('remote', host))
+                              for host in hosts if ('remote', host) in changed}
+            frame['checked_at'] = self.get_checked_at(hosts)
+            for section in SECTIONS:
+                if section in changed:
+                    frame.update(self.render_section(section))
+            return encode(frame, encoding)
+
+    def render_data(self, since=None, encoding='json', view=None):
+        '''Like `render_delta`, with the structured fields of the hosts and sections instead of html.
+
+        Nothing is formatted nor converted here, the page renders the fields itself.
+        '''
+        with RENDER_SECONDS.time(kind='data'):
+            context = self.context
+            version = context.version
+            hosts = self.get_hosts(view)
+            if since is None or since > version:
+                frame = {'type': 'full', 'base': None}
+                changed = set([('remote', host) for host in hosts] + SECTIONS)
+            else:
+                frame = {'type': 'delta', 'base': since}
+                changed = set(context.changed_sections(since))
+            frame['format'] = 'data'
+            frame['version'] = version
+            frame['host_order'] = hosts
+            frame['hosts'] = {host: context.get_remote_data(host)
+                              for host in hosts if ('remote', host) in changed}
+            frame['checked_at'] = self.get_checked_at(hosts)
+            if 'disk' in changed:
+                frame['disk'], disk_time = context.get_disk_data()
+                frame['disk_status_time'] = now_time(disk_time)
+            if 'notification' in changed:
+                frame['notification_text'] = escape_ansi(context.get_notification())
+            if 'top_users' in changed:
+                status, status_time, status_comment = context.get_top_users_status()
+                frame['top_users_status'] = status
+                frame['top_users_status_time'] = now_time(status_time)
+                frame['top_users_status_comment'] = escape_ansi(status_comment)
+            if 'network' in changed:
+                frame['network'], network_time = context.get_all_network_data()
+                frame['network_status_time'] = now_time(network_time)
+            return encode(frame, encoding)
@@ -0,0 +1,289 @@
+import asyncio
+import bisect
+import itertools
+import math
+import os
+import re
+import time
+from array import array
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# host and metric names are file names of the `MetricStore`
+NAME = re.compile(r'^[\w\-][\w.\-]*$')
+
+
+class RingBuffer():
+    '''Fixed-size, array-backed buffer of (time, value) samples. The oldest is overwritten when full.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.values = array('f', bytes(4 * size))
+        self.head = 0
+        self.count = 0
+
+    def append(self, t, value):
+        self.times[self.head] = t
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def first_time(self):
+        return self.times[(self.head - self.count) % self.size] if self.count else None
+
+    def query(self, start=None, end=None):
+        '''Returns ([times], [values]) in time order, within [start, end].'''
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        times, values = [], []
+        first = self.head - self.count
+        for i in range(first, self.head):
+            t = self.times[i % self.size]
+            if start <= t <= end:
+                times.append(t)
+                values.append(self.values[i % self.size])
+        return times, values
+
+
+class Tier():
+    '''Averages the samples into buckets of `resolution` seconds, keeping `retention` seconds of them.'''
+
+    def __init__(self, resolution, retention):
+        self.resolution = resolution
+        self.retention = retention
+        self.buffer = RingBuffer(max(1, int(retention // resolution)))
+        self.bucket = None
+        self.bucket_sum = 0.0
+        self.bucket_count = 0
+
+    def append(self, t, value):
+        bucket = int(t // self.resolution)
+        if bucket != self.bucket:
+            self.flush()
+            self.bucket = bucket
+        self.bucket_sum += value
+        self.bucket_count += 1
+
+    def first_time(self):
+        first = self.buffer.first_time()
+        if first is None and self.bucket_count:
+            first = float(self.bucket * self.resolution)
+        return first
+
+    def flush(self):
+        if self.bucket_count:
+            self.buffer.append(self.bucket * self.resolution, self.bucket_sum / self.bucket_count)
+        self.bucket_sum = 0.0
+        self.bucket_count = 0
+
+    def query(self, start=None, end=None):
+        times, values = self.buffer.query(start, end)
+        if self.bucket_count:
+            # the open bucket is not flushed yet
+            t = float(self.bucket * self.resolution)
+            if (start is None or t >= start) and (end is None or t <= end):
+                times.append(t)
+                values.append(self.bucket_sum / self.bucket_count)
+        return times, values
+
+
+class Series():
+    def __init__(self, tiers):
+        self.tiers = [Tier(resolution, retention) for resolution, retention in tiers]
+
+    def append(self, t, value):
+        for tier in self.tiers:
+            tier.append(t, value)
+
+    def pick_tier(self, start=None):
+        '''The finest tier still covering `start`.'''
+        for tier in self.tiers:
+            first = tier.buffer.first_time()
+            if start is None or first is None or first <= start or tier.buffer.count < tier.buffer.size:
+                return tier
+        return self.tiers[-1]
+
+    def query(self, start=None, end=None):
+        return self.pick_tier(start).query(start, end)
+
+
+class TimeSeriesStore():
+    '''In-memory history per host and metric, e.g. ('db15', 'gpu0.util').
+
+    `tiers` is a list of (resolution, retention) in seconds, finest first,
+    e.g. [(1, 3600), (60, 24 * 3600)] keeps 1s samples for 1 hour and 1min averages for 24 hours.
+    '''
+
+    def __init__(self, tiers=((1, 3600), (60, 24 * 3600))):
+        self.tiers = sorted(tiers)
+        self.series = {}
+
+    def record(self, host, metrics, t=None):
+        '''`metrics` is a dict of {metric: value}.'''
+        t = time.time() if t is None else t
+        for metric, value in metrics.items():
+            if value is None:
+                # e.g. the power draw of some GPUs is not available
+                continue
+            key = (host, metric)
+            if key not in self.series:
+                self.series[key] = Series(self.tiers)
+            self.series[key].append(t, value)
+
+    def query(self, host, metric, start=None, end=None):
+        '''Returns ([times], [values]) of the finest tier covering `start`.'''
+        series = self.series.get((host, metric))
+        if series is None:
+            return [], []
+        return series.query(start, end)
+
+    def covers(self, host, metric, start):
+        '''Whether the finest tier holds the samples since `start`, i.e. they were recorded since then.'''
+        series = self.series.get((host, metric))
+        if series is None:
+            return False
+        first = series.tiers[0].first_time()
+        return first is not None and first <= start
+
+    def get_metrics(self, host):
+        return sorted(metric for h, metric in self.series if h == host)
+
+
+def get_day(t):
+    return time.strftime('%Y%m%d', time.gmtime(t))
+
+
+class MetricStore():
+    '''Persistent history per host and metric, in append-only files of one UTC day:
+    `<path>/<host>/<metric>.<YYYYMMDD>.bin`, holding (time, value) float64 pairs.
+
+    The samples are buffered in memory and appended by `flush_async`, off the event loop.
+    Files older than `retention` seconds are deleted by `expire`.
+    '''
+
+    def __init__(self, path='history', retention=30 * 86400):
+        self.path = path
+        self.retention = retention
+        self.pending = defaultdict(list)
+        # the samples being appended by `flush_async`, still read by `query` meanwhile
+        self.writing = {}
+
+    @staticmethod
+    def is_valid(name):
+        return bool(NAME.match(name))
+
+    def append(self, host, metrics, t):
+        '''`metrics` is a dict of {metric: value}.'''
+        if not self.is_valid(host):
+            return
+        for metric, value in metrics.items():
+            # e.g. the power draw of some GPUs is not available
+            if value is not None and self.is_valid(metric):
+                self.pending[(host, metric)].append((t, float(value)))
+
+    def get_file(self, host, metric, day):
+        return os.path.join(self.path, host, f'{metric}.{day}.bin')
+
+    async def flush_async(self, executor=None):
+        '''Appends the buffered samples to their files, off the event loop. Returns the number of samples.'''
+        self.writing, self.pending = self.pending, defaultdict(list)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, self.write, self.writing)
+        finally:
+            self.writing = {}
+
+    def write(self, batch):
+        count = 0
+        for (host, metric), samples in batch.items():
+            os.makedirs(os.path.join(self.path, host), exist_ok=True)
+            for day, day_samples in itertools.groupby(samples, key=lambda sample: get_day(sample[0])):
+                data = array('d', [x for sample in day_samples for x in sample])
+                with open(self.get_file(host, metric, day), 'ab') as f:
+                    data.tofile(f)
+                count += len(data) // 2
+        return count
+
+    def expire(self, now=None):
+        '''Deletes the files of the days older than `retention`. Returns the number of files deleted.'''
+        oldest = get_day((time.time() if now is None else now) - self.retention)
+        deleted = 0
+        if not os.path.isdir(self.path):
+            return deleted
+        for host in os.listdir(self.path):
+            for name in os.listdir(os.path.join(self.path, host)):
+                if name.endswith('.bin') and name[-12:-4] < oldest:
+                    os.remove(os.path.join(self.path, host, name))
+                    deleted += 1
+        return deleted
+
+    def get_hosts(self):
+        return sorted(os.listdir(self.path)) if os.path.isdir(self.path) else []
+
+    def get_metrics(self, host):
+        metrics = set(metric for h, metric in self.pending if h == host)
+        if self.is_valid(host) and os.path.isdir(os.path.join(self.path, host)):
+            metrics.update(name[:-13] for name in os.listdir(os.path.join(self.path, host)) if name.endswith('.bin'))
+        return sorted(metrics)
+
+    def query(self, host, metric, start, end):
+        '''Returns ([times], [values]) within [start, end], in time order. Blocking, run it in an executor.'''
+        if not (self.is_valid(host) and self.is_valid(metric)):
+            return array('d'), array('d')
+        # taken first: the samples flushed meanwhile are then in the files too, and skipped below
+        buffered = list(self.writing.get((host, metric), [])) + list(self.pending.get((host, metric), []))
+        data = array('d')
+        day = start - start % 86400
+        while day <= end:
+            try:
+                with open(self.get_file(host, metric, get_day(day)), 'rb') as f:
+                    raw = f.read()
+                # a sample may be half appended
+                data.frombytes(raw[:len(raw) - len(raw) % 16])
+            except FileNotFoundError:
+                pass
+            day += 86400
+        times, values = data[0::2], data[1::2]
+        last = times[-1] if times else -math.inf
+        for t, value in buffered:
+            if t > last:
+                times.append(t)
+                values.append(value)
+        if any(times[i] > times[i + 1] for i in range(len(times) - 1)):
+            # e.g. the clock went back
+            order = sorted(range(len(times)), key=times.__getitem__)
+            times, values = array('d', [times[i] for i in order]), array('d', [values[i] for i in order])
+        first, stop = bisect.bisect_left(times, start), bisect.bisect_right(times, end)
+        return times[first:stop], values[first:stop]
+
+
+def downsample(times, values, start, step):
+    '''Buckets the samples (sequences of floats, in time order) into `step` seconds from `start`.
+
+    Returns {'t': [bucket starts], 'min': [...], 'max': [...], 'avg': [...]}, without the empty buckets.
+    Vectorized with numpy if it is installed.
+    '''
+    if not len(times):
+        return {'t': [], 'min': [], 'max': [], 'avg': []}
+    if numpy is not None:
+        t, v = numpy.asarray(times, dtype='d'), numpy.asarray(values, dtype='d')
+        buckets = ((t - start) // step).astype(numpy.int64)
+        # the buckets are contiguous runs, as the samples are in time order
+        firsts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+        counts = numpy.diff(numpy.append(firsts, len(v)))
+        return {'t': (start + buckets[firsts] * step).tolist(),
+                'min': numpy.minimum.reduceat(v, firsts).round(3).tolist(),
+                'max': numpy.maximum.reduceat(v, firsts).round(3).tolist(),
+                'avg': (numpy.add.reduceat(v, firsts) / counts).round(3).tolist()}
+    result = {'t': [], 'min': [], 'max': [], 'avg': []}
+    for bucket, samples in itertools.groupby(zip(times, values), key=lambda sample: (sample[0] - start) // step):
+        bucket_values = [value for _, value in samples]
+        result['t'].append(start + bucket * step)
+        result['min'].append(round(min(bucket_values), 3))
+        result['max'].append(round(max(bucket_values), 3))
+        result['avg'].append(round(sum(bucket_values) / len(bucket_values), 3))
+    return result
@@ -2,3 +2,7 @@ from .remote_gpu_worker import RemoteGPUWorker
 from .remote_network_worker import RemoteNetworkWorker
 from .local_disk_worker import LocalDiskWorker
 from .local_db_worker import LocalDBWorker
+from .local_compaction_worker import LocalCompactionWorker
+from .local_history_worker import LocalHistoryWorker
+from .ssh_pool import SSHConnectionPool
+from .scheduler import PollScheduler
@@ -0,0 +1,91 @@
+'''
+On-node agent of the streaming mode.
+
+Launched over SSH as `python3 -u -c <this file> <interval>`, it samples
+/proc every `interval` seconds and writes one json line per sample to stdout.
+The keys and text formats mimic the outputs of `REMOTE_CMD`, so that the
+samples are parsed by the same `RemoteGPUWorker.process_result_dict`.
+It must only depend on the standard library (and optionally gpustat).
+'''
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+GPUSTAT_CMD = ['gpustat', '--json']
+
+
+def read_cpu():
+    with open('/proc/stat') as f:
+        values = [int(x) for x in f.readline().split()[1:]]
+    return values[3], sum(values)
+
+
+def read_network():
+    res = {}
+    with open('/proc/net/dev') as f:
+        for line in f.readlines()[2:]:
+            name, data = line.split(':', 1)
+            name = name.strip()
+            if name == 'lo':
+                continue
+            data = data.split()
+            res[name] = (int(data[0]), int(data[8]))
+    return res
+
+
+def read_memory():
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0]) / 1024 / 1024  # GB
+    available = info.get('MemAvailable', info['MemFree'])
+    return (f"              total        used        free      shared  buff/cache   available\n"
+            f"Mem: {info['MemTotal']:.1f}G {info['MemTotal'] - available:.1f}G {info['MemFree']:.1f}G 0G 0G {available:.1f}G\n"
+            f"Swap: {info.get('SwapTotal', 0):.1f}G 0G 0G")
+
+
+def read_gpustat():
+    try:
+        import gpustat
+        from io import StringIO
+        buf = StringIO()
+        gpustat.new_query().print_json(fp=buf)
+        return buf.getvalue().strip()
+    except ImportError:
+        pass
+    try:
+        return subprocess.run(GPUSTAT_CMD, stdout=subprocess.PIPE, universal_newlines=True).stdout.rstrip('\n')
+    except OSError:
+        return ''
+
+
+def main(interval):
+    last_cpu, last_network, last_time = read_cpu(), read_network(), time.time()
+    while True:
+        time.sleep(interval)
+        cpu, network, now = read_cpu(), read_network(), time.time()
+        elapsed = max(now - last_time, 1e-3)
+
+        idle = 100.0 * (cpu[0] - last_cpu[0]) / max(cpu[1] - last_cpu[1], 1)
+        rates = []
+        for name, (rx, tx) in network.items():
+            last_rx, last_tx = last_network.get(name, (rx, tx))
+            rates.append(f'{(rx - last_rx) / 1024 / elapsed:.2f} {(tx - last_tx) / 1024 / elapsed:.2f}')
+        last_cpu, last_network, last_time = cpu, network, now
+
+        sample = {'CPU_NEW': f'{idle:.2f}',
+                  'NETWORK': '\n'.join(rates) or '0 0',
+                  'MEM': read_memory(),
+                  'CUDA': '\n'.join(sorted(os.listdir('/usr/local'))),
+                  'GPUSTAT': read_gpustat(),
+                  'time': now}
+        sys.stdout.write(json.dumps(sample) + '\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 1.0)
@@ -0,0 +1,32 @@
+import time
+
+from utils import msg_from_host
+
+from .worker import Worker
+
+
+class LocalCompactionWorker(Worker):
+    '''Expires old raw samples and hourly rollups of the usage database, in small batches.'''
+
+    def __init__(self, context, db, host='localhost', poll_delay=3600, timeout=600,
+                 raw_retention=8 * 86400, hourly_retention=90 * 86400):
+        worker_type = 'function-compaction'
+        super().__init__(context, worker_type, host=host, poll_delay=poll_delay, timeout=timeout)
+        self.db = db
+        self.raw_retention = raw_retention
+        self.hourly_retention = hourly_retention
+        self.set_worker_function(self.compact)
+
+    async def compact(self):
+        start_time = time.time()
+        raw, hourly = await self.db.compact_async(raw_retention=self.raw_retention,
+                                                  hourly_retention=self.hourly_retention)
+        return {'raw': raw, 'hourly': hourly, 'consumed_time': time.time() - start_time}
+
+    def process_result_dict(self, result_dict):
+        msg_from_host(self.worker_name, f"Compacted {result_dict['raw']} raw and {result_dict['hourly']} hourly rows "
+                      f"in {result_dict['consumed_time']:.2f}s", attrs=['bold'])
+        return result_dict['consumed_time']
+
+    def on_error(self, msg):
+        pass
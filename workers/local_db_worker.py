@@ -1,23 +1,45 @@
+import asyncio
 import re
 import time
-from collections import Counter, defaultdict
+from collections import defaultdict
 
 from termcolor import colored
 
-from db import Database
+from db import Database, UsageBuffer
+from gpu import get_name_usage
 from utils import escape_ansi, get_float, msg_from_host, now_time
 
 from .worker import Worker
 
 
 class LocalDBWorker(Worker):
-    def __init__(self, context, db_path, host='localhost', poll_delay=8, timeout=60):
+    '''Accounts the GPU usage of every report of the hosts, and reads the top users every `poll_delay`.
+
+    The usage is buffered and written behind, see `UsageBuffer`. A failed write is kept and
+    retried with exponential backoff, up to `max_backoff` seconds.
+    '''
+
+    def __init__(self, context, db_path=None, host='localhost', poll_delay=8, timeout=60, db=None,
+                 flush_rows=1000, flush_interval=60, buffer_limit=100000, max_gap=120, max_backoff=300):
         worker_type = 'function-db'
         super().__init__(context, worker_type, host=host, poll_delay=poll_delay, timeout=timeout)
-        self.db = Database(path=db_path)
+        self.db = db or Database(path=db_path)
         self.set_worker_function(self.read_and_write_db)
+        # every report of the hosts, including the unchanged ones
+        self.events = context.bus.subscribe('db', types=['remote'], changed_only=False)
+        self.buffer = UsageBuffer(max_rows=flush_rows, max_age=flush_interval, limit=buffer_limit)
+        # a host silent for longer than `max_gap` seconds is not accounted for the gap
+        self.max_gap = max_gap
+        self.max_backoff = max_backoff
+        # host -> (time of its last report, {name: MB} reported then)
+        self.last_usages = {}
+        self.next_read = 0.0
+        self.flush_task = None
+        self.flush_failures = 0
+        self.next_flush = 0.0
 
     def get_name_usage(self, text):
+        '''Parses per-user memory out of the colored gpustat text, for hosts without gpu records.'''
         name_usage_dict = defaultdict(int)
         pattern = re.compile('\s([a-zA-Z]+)\(([0-9]+)M\)')
         text = escape_ansi(text)
@@ -25,49 +47,100 @@ class LocalDBWorker(Worker):
             name_usage_dict[name] += int(usage)
         return name_usage_dict
 
+    def get_host_usage(self, host):
+        info = self.context.get_all_remote_status()[host]
+        # the last usage of a failing gpustat is not accounted again
+        if not info.is_success or 'GPUSTAT' in (info.data or {}).get('stale', ()):
+            return None
+        gpustat = self.context.get_gpu_status(host)
+        if gpustat is not None:
+            return get_name_usage(gpustat.gpus)
+        return self.get_name_usage(info.msg)
+
+    def sample(self, events):
+        '''Accounts the usage reported by each host until its new report.'''
+        for event in sorted(events, key=lambda event: event.time):
+            host = event.section[1]
+            last = self.last_usages.pop(host, None)
+            if last is not None:
+                last_time, usage = last
+                self.buffer.add(usage, event.time, min(event.time - last_time, self.max_gap))
+            usage = self.get_host_usage(host)
+            if usage is not None:
+                self.last_usages[host] = (event.time, usage)
+
+    def next_delay(self, consumed_time=0.0):
+        # paced by the reports of the hosts, see `read_and_write_db`
+        return 0.0
+
+    async def flush(self):
+        rows = self.buffer.take()
+        if not rows:
+            return
+        start_time = time.time()
+        try:
+            await self.db.insert_async(rows, auto_time=False)
+        except Exception as ex:
+            self.buffer.put_back(rows)
+            self.flush_failures += 1
+            backoff = min(self.max_backoff, 2 ** self.flush_failures)
+            self.next_flush = time.time() + backoff
+            self.on_error(f"DB error: <write> {ex}, {len(self.buffer.rows)} rows kept, retrying in {backoff} sec")
+            return
+        self.flush_failures = 0
+        msg_from_host(self.worker_name, f"Database wrote {len(rows)} rows of {len(set(r[0] for r in rows))} users "
+                                        f"in {time.time() - start_time:.2f}s", attrs=['bold'])
+
     async def read_and_write_db(self):
-        msg_from_host(self.worker_name, 'Database starting to process...', attrs=['bold'])
+        '''Waits for reports until the next read or write is due, returns the read if any.'''
+        due = self.next_read
+        if self.buffer.since is not None:
+            due = min(due, max(self.next_flush, self.buffer.since + self.buffer.max_age))
+        try:
+            events = await asyncio.wait_for(self.events.get(), timeout=max(0.0, due - time.time()))
+        except asyncio.TimeoutError:
+            events = []
+        self.sample(events)
+
+        # written in the background, the reports keep being accounted meanwhile
+        writing = self.flush_task is not None and not self.flush_task.done()
+        if self.buffer.is_due() and not writing and time.time() >= self.next_flush:
+            self.flush_task = asyncio.create_task(self.flush())
+
         result = {}
+        if time.time() < self.next_read:
+            return result
+        self.next_read = time.time() + self.poll_delay
         start_time = time.time()
         try:
-            result['read'] = {'past1hour': await self.db.past_async('-1 hour'),
-                              'past24hours': await self.db.past_async('-24 hours'),
-                              'past3days': await self.db.past_async('-3 days'),
-                              'past7days': await self.db.past_async('-7 days')}
+            result['read'] = await self.db.past_windows_async()
             result['read_error'] = None
         except Exception as ex:
             result['read_error'] = str(ex)
-            # raise
-
-        try:
-            raw = self.context.get_all_remote_status()
-            usages = Counter()
-            write_log = []
-            for host, info in raw.items():
-                if time.time() - info.update_time > 100 or not info.is_success:
-                    continue
-                write_log.append(host)
-                usages += Counter(self.get_name_usage(info.msg))
-            to_write = list(usages.items())
-            if to_write:
-                await self.db.insert_async(to_write)
-            result['write'] = ' '.join(write_log) or '(null)'
-            result['write_error'] = None
-        except Exception as ex:
-            result['write_error'] = str(ex)
         result['consumed_time'] = time.time() - start_time
         return result
 
     def process_result_dict(self, result_dict):
+        if not result_dict:
+            return
         if result_dict['read_error'] is None:
             msg_from_host(self.worker_name, 'Database successfully read.', attrs=['bold'])
             self.context.update_top_users_status(result_dict['read'])
-        if result_dict['write_error'] is None:
-            msg_from_host(self.worker_name, f"Database written hosts: {result_dict['write']}", attrs=['bold'])
-        if (result_dict['read_error'] is not None) or (result_dict['write_error'] is not None):
-            self.on_error(f"DB error: <read> {result_dict['read_error']} <write> {result_dict['write_error']}")
+        else:
+            self.on_error(f"DB error: <read> {result_dict['read_error']}")
         msg_from_host(self.worker_name, f"Database consumed time: {result_dict['consumed_time']:.2f}s", attrs=['bold'])
         return result_dict['consumed_time']
 
+    async def run(self):
+        try:
+            await super().run()
+        finally:
+            # the buffered usage is written before closing
+            if self.flush_task is not None:
+                await asyncio.gather(self.flush_task, return_exceptions=True)
+            await self.flush()
+            # the connections are long-lived, and their threads would keep the process alive
+            await self.db.close_async()
+
     def on_error(self, msg):
         self.context.update_top_users_status(msg, is_success=False)
@@ -19,17 +19,19 @@ class LocalDiskWorker(Worker):
         template = colored("{:<12}", 'green') + " \033[90m{:>6} {:>6}\033[0m"
         res = colored('{:<12} {:>6} {:>6}'.format('Filesystem', 'Used', 'Avail'), 'white')
         disks = []
+        rows = []
         for line in result_dict['DISK'].split('\n'):
             blocks = list(filter(None, line.split(' ')))
             if len(blocks) <= 3 or len(blocks[-1]) < 3:
                 continue
             disks.append(template.format(blocks[-1], blocks[-4], blocks[-3]))
+            rows.append([blocks[-1], blocks[-4], blocks[-3]])
         disk_info = '\n'.join([res] + sorted(disks))
 
         # notification
         notification_info = result_dict['NOTIFICATION']
 
-        self.context.update_disk_status(disk_info)
+        self.context.update_disk_status(disk_info, data={'disks': sorted(rows)})
         self.context.update_notification(notification_info)
         return disk_info, notification_info
 
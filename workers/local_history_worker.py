@@ -0,0 +1,40 @@
+import time
+
+from utils import msg_from_host
+
+from .worker import Worker
+
+
+class LocalHistoryWorker(Worker):
+    '''Appends the buffered metric history to its files, and deletes the expired days.'''
+
+    def __init__(self, context, store, host='localhost', poll_delay=30, timeout=600, expire_interval=3600):
+        worker_type = 'function-history'
+        super().__init__(context, worker_type, host=host, poll_delay=poll_delay, timeout=timeout)
+        self.store = store
+        self.expire_interval = expire_interval
+        self.next_expire = 0.0
+        self.set_worker_function(self.flush)
+
+    async def flush(self):
+        start_time = time.time()
+        result = {'samples': await self.store.flush_async(), 'expired': 0}
+        if start_time >= self.next_expire:
+            self.next_expire = start_time + self.expire_interval
+            result['expired'] = self.store.expire()
+        result['consumed_time'] = time.time() - start_time
+        return result
+
+    def process_result_dict(self, result_dict):
+        if result_dict['expired']:
+            msg_from_host(self.worker_name, f"Deleted {result_dict['expired']} expired history files", attrs=['bold'])
+        return result_dict['consumed_time']
+
+    async def run(self):
+        try:
+            await super().run()
+        finally:
+            await self.store.flush_async()
+
+    def on_error(self, msg):
+        pass
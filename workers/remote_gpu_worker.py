@@ -1,36 +1,126 @@
 import re
+import shlex
+from pathlib import Path
 
 from termcolor import colored
 
+from gpu import format_gpus, get_gpu_fields, get_gpu_metrics, parse_gpustat_json
+from metrics import registry
 from utils import get_float, now_time, escape_ansi
 
 from .worker import Worker
 
+UNCHANGED = registry.counter('gpustat_remote_unchanged_total', 'Polls whose shown values did not change, only marking '
+                             'the host fresh.', ['host'])
+
+AGENT_SCRIPT = (Path(__file__).parent / 'agent.py').read_text()
+QUERY_TIME = re.compile(r'"query_time": "[^"]*",?')
+
 
 class RemoteGPUWorker(Worker):
-    def __init__(self, context, cmd_dict, host='db1', port=22, poll_delay=8, timeout=60):
+    def __init__(self, context, cmd_dict, host='db1', port=22, poll_delay=8, timeout=60, ssh_pool=None,
+                 stream=False, stream_interval=1, scheduler=None, cmd_timeouts=None, cmd_intervals=None):
         worker_type = 'remote-gpu'
-        super().__init__(context, worker_type, host=host, poll_delay=poll_delay, timeout=timeout)
-        self.set_cmd_line(cmd_dict)
+        super().__init__(context, worker_type, host=host, poll_delay=poll_delay, timeout=timeout, ssh_pool=ssh_pool,
+                         scheduler=scheduler)
+        self.set_cmd_line(cmd_dict, timeouts=cmd_timeouts, intervals=cmd_intervals)
+        if stream:
+            # one long-lived agent per host instead of re-running `cmd_dict` every `poll_delay`
+            self.set_stream_cmd(f"python3 -u -c {shlex.quote(AGENT_SCRIPT)} {stream_interval}")
         self.port = port
+        self.last_gpu_signature = None
+        # what was last written to the context, see `process_result_dict`
+        self.last_shown = None
         self.on_error(colored('Connecting...', color='red'))
 
     def process_result_dict(self, result_dict):
-        # print(result_dict['CPU_NEW'])
-        # CPU
-        cpu_idle = result_dict['CPU_NEW'].strip().split(' ')[-1]
+        # each section is parsed and formatted again only when its output changed
+        (cpu_percent, cpu_info), _ = self.parse_section('CPU_NEW', result_dict['CPU_NEW'], self.parse_cpu)
+        (up, down, network_info), _ = self.parse_section('NETWORK', result_dict['NETWORK'], self.parse_network)
+        (used, total, mem_info), _ = self.parse_section('MEM', result_dict['MEM'], self.parse_mem)
+        cuda_installed, _ = self.parse_section('CUDA', result_dict['CUDA'], self.parse_cuda)
+        gpu, _ = self.parse_section('GPUSTAT', result_dict['GPUSTAT'], self.parse_gpustat,
+                                    normalize=self.normalize_gpustat)
+
+        # the last results of the failed commands are shown, but not recorded again
+        metrics = {}
+        if 'CPU_NEW' not in self.stale_keys:
+            metrics['cpu'] = cpu_percent * 100
+        if 'MEM' not in self.stale_keys:
+            metrics.update(mem_used=used, mem_total=total)
+        if 'NETWORK' not in self.stale_keys:
+            metrics.update(net_up=up, net_down=down)
+        if 'GPUSTAT' not in self.stale_keys:
+            metrics.update(gpu['metrics'])
+        self.context.record_metrics(self.host, metrics)
+
+        # read by the scheduler: idle hosts are polled less often
+        self.active = gpu['active']
+        self.changed = gpu['signature'] != self.last_gpu_signature
+        self.last_gpu_signature = gpu['signature']
+
+        if gpu['gpustat'] is not None and gpu['gpustat'] != self.context.get_gpu_status(self.host):
+            self.context.update_gpu_status(self.host, gpu['gpustat'])
+
+        # IO busy?
+        if cpu_percent > 0.85 or used / total > 0.91 or down > 300:
+            io_info = colored(' [busy]', 'cyan', attrs=['bold'])  # '\033[1;96m{}\033[0m'.format('[busy]')
+        else:
+            io_info = ''
+
+        # the structured fields, rendered by the web client itself
+        flags = [('cpu', cpu_percent > 0.85), ('mem', used / total > 0.80), ('net', down > 200), ('busy', bool(io_info))]
+        data = {'driver': '', 'cuda': cuda_installed,
+                'cpu': round(cpu_percent * 100, 1), 'mem': [round(used, 1), round(total, 1)],
+                'net': [round(down, 1), round(up, 1)], 'flags': [flag for flag, on in flags if on],
+                'stale': sorted(self.stale_keys)}
+        data.update(gpu['fields'])
+
+        # commands that failed this time, shown with their last result
+        if self.stale_keys:
+            io_info += colored(' [stale: {}]'.format('/'.join(sorted(self.stale_keys)).lower()), 'yellow')
+
+        # the raw outputs change on every poll (e.g. the decimals of iostat and sar), what is shown may not
+        title, driver = gpu['title'], gpu['driver']
+        shown = (title, io_info, cpu_info, network_info, mem_info, driver, cuda_installed, gpu['details'], data)
+        if shown == self.last_shown:
+            # only the freshness is updated, so the rendered caches stay valid; not while a command keeps failing
+            if self.stale_keys or self.context.touch_remote_status(self.host):
+                UNCHANGED.inc(host=self.host)
+                return
+        self.last_shown = shown
+
+        data = dict(data, time=now_time(simple=True))
+        time_info = '\033[;30m{}\033[0m'.format(data['time'])
+
+        # final
+        # io_info = ''
+        gpu_info = f"{title} {io_info}  {cpu_info}  {network_info} {mem_info}{time_info}   {driver}  CUDA: {cuda_installed}\n" + \
+            "\n".join(gpu['details'])
+        # count_info = count_top(results[gpu_at + 2:])
+        count_info = None
+        gpu_info = gpu_info.replace(',', '')
+        # fix
+        final_result = gpu_info.replace('GeForce GTX', ''), count_info
+
+        self.context.update_remote_status(self.host, final_result[0], data=data)
+
+    @staticmethod
+    def parse_cpu(text):
+        cpu_idle = text.strip().split(' ')[-1]
         cpu_percent = 1.0 - float(cpu_idle) / 100
         cpu_raw = '{:.1f}%'.format(cpu_percent * 100)
         if cpu_percent > 0.85:
             cpu_info = '\033[;30mCPU\033[0m \033[1;35m{}\033[0m'.format(cpu_raw.ljust(6))
         else:
             cpu_info = '\033[;30mCPU\033[0m \033[;39m{}\033[0m'.format(cpu_raw.ljust(6))
+        return cpu_percent, cpu_info
 
-        # Network
-        network = result_dict['NETWORK'].split('\n')
+    @staticmethod
+    def parse_network(text):
         uploads = []
         downloads = []
-        for line in network:
+        for line in text.split('\n'):
             down, up = line.strip().split(' ')
             uploads.append(float(up))
             downloads.append(float(down))
@@ -40,9 +130,11 @@ class RemoteGPUWorker(Worker):
             network_info = 'IO↓ ' + colored(f'{down:.1f}Mb/s'.ljust(10), 'magenta', attrs=['bold'])
         else:
             network_info = 'IO↓ ' + f'{down:.1f}Mb/s'.ljust(10)
+        return up, down, network_info
 
-        # MEM
-        mem_result = result_dict['MEM'].split('\n')
+    @staticmethod
+    def parse_mem(text):
+        mem_result = text.split('\n')
         if 'buffers/cache' in mem_result[2]:
             # ubuntu 14
             used_str, free_str = list(filter(None, mem_result[2].split(' ')))[-2:]
@@ -58,26 +150,52 @@ class RemoteGPUWorker(Worker):
             mem_info = '\033[;30mMEM(used)\033[0m \033[1;35m{}\033[0m'.format(memory_raw)
         else:
             mem_info = '\033[;30mMEM(used)\033[0m \033[;39m{}\033[0m'.format(memory_raw)
+        return used, total, mem_info
 
-        # IO busy?
-        if cpu_percent > 0.85 or used / total > 0.91 or down > 300:
-            io_info = colored(' [busy]', 'cyan', attrs=['bold'])  # '\033[1;96m{}\033[0m'.format('[busy]')
-        else:
-            io_info = ''
-
-        # CUDA
+    @staticmethod
+    def parse_cuda(text):
         def get_cuda_version(s):
             try:
                 return re.search('cuda-([0-9]+.[0-9])', s).group(1)
             except Exception:
                 return ''
-        cuda_installed = "/".join(
-            sorted(set(filter(None, map(get_cuda_version, result_dict['CUDA'].split('\n')))),
-                   key=float, reverse=True))
+        return "/".join(sorted(set(filter(None, map(get_cuda_version, text.split('\n')))), key=float, reverse=True))
+
+    @staticmethod
+    def normalize_gpustat(text):
+        '''The output without its query time, which changes on every poll.'''
+        if text.lstrip().startswith('{'):
+            return QUERY_TIME.sub('', text)
+        # the header of the text is `<hostname>  <query time>  <driver version>`
+        header, _, rest = text.partition('\n')
+        words = header.split(' ')
+        return f'{words[0]} {words[-1]}\n{rest}'
 
-        # GPUstat
-        gpu_result = result_dict['GPUSTAT'].split('\n')
-        time_info = '\033[;30m{}\033[0m'.format(now_time(simple=True))
+    def parse_gpustat(self, text):
+        if text.lstrip().startswith('{'):
+            # `gpustat --json`: typed records, also used by the DB worker
+            gpustat = parse_gpustat_json(text)
+            title = colored(gpustat.hostname, attrs=['bold'], color='white')
+            driver = gpustat.driver_version
+            return {'gpustat': gpustat, 'title': title, 'driver': driver,
+                    'details': [format_gpus(gpustat.gpus)] if gpustat.gpus else [],
+                    'fields': {'hostname': gpustat.hostname, 'driver': driver, 'gpus': get_gpu_fields(gpustat.gpus)},
+                    'metrics': get_gpu_metrics(gpustat.gpus),
+                    'active': any(gpu.utilization or gpu.processes for gpu in gpustat.gpus),
+                    'signature': tuple((gpu.utilization, gpu.memory_used, gpu.processes) for gpu in gpustat.gpus)}
+        title, driver, gpu_details = self.parse_gpustat_text(text)
+        plain = escape_ansi(text)
+        return {'gpustat': None, 'title': title, 'driver': driver, 'details': gpu_details,
+                'fields': {'hostname': escape_ansi(title), 'driver': driver,
+                           'gpu_text': escape_ansi('\n'.join(gpu_details))},
+                'metrics': {},
+                # any process listed as `user(123M)`
+                'active': re.search(r'\(\d+M\)', plain) is not None,
+                'signature': plain.split('\n', 1)[-1]}
+
+    def parse_gpustat_text(self, text):
+        '''Parses the colored text of `gpustat -P --color`.'''
+        gpu_result = text.split('\n')
         title = colored(escape_ansi(gpu_result[0]).split(' ')[0], attrs=['bold'], color='white')
         driver = gpu_result[0].split(' ')[-1]
 
@@ -89,18 +207,7 @@ class RemoteGPUWorker(Worker):
             parts[1] = parts[1][:-32] + colored('W ', 'magenta')
             gpu_details.append(f"{parts[0][:8]}{parts[2]}|{parts[0][8:]}{parts[1]}|{'|'.join(parts[3:])}")
             # gpu_details.append('|'.join(parts))
-
-        # final
-        # io_info = ''
-        gpu_info = f"{title} {io_info}  {cpu_info}  {network_info} {mem_info}{time_info}   {driver}  CUDA: {cuda_installed}\n" + \
-            "\n".join(gpu_details)
-        # count_info = count_top(results[gpu_at + 2:])
-        count_info = None
-        gpu_info = gpu_info.replace(',', '')
-        # fix
-        final_result = gpu_info.replace('GeForce GTX', ''), count_info
-
-        self.context.update_remote_status(self.host, final_result[0])
+        return title, driver, gpu_details
 
     def on_error(self, msg):
         self.context.update_remote_status(self.host, msg, is_success=False)
@@ -6,9 +6,11 @@ from .worker import Worker
 
 
 class RemoteNetworkWorker(Worker):
-    def __init__(self, context, cmd_dict, duration, interface, host='db1', port=22, poll_delay=8, timeout=60):
+    def __init__(self, context, cmd_dict, duration, interface, host='db1', port=22, poll_delay=8, timeout=60,
+                 ssh_pool=None, scheduler=None):
         worker_type = 'remote-network'
-        super().__init__(context, worker_type, host=host, poll_delay=poll_delay, timeout=timeout)
+        super().__init__(context, worker_type, host=host, poll_delay=poll_delay, timeout=timeout, ssh_pool=ssh_pool,
+                         scheduler=scheduler)
         self.set_cmd_line({'NETWORK': cmd_dict['NETWORK'].format(em=interface, t=duration)})
         self.port = port
         self.on_error(colored('Checking...', color='yellow'))
@@ -21,7 +23,7 @@ class RemoteNetworkWorker(Worker):
         
         template = colored("{:<4}", 'green') + " \033[90m{:>6}Mb/s {:>6}Mb/s\033[0m"
         res = template.format(self.host, f'{upload:.1f}', f'{download:.1f}')
-        self.context.update_network_status(self.host, res)
+        self.context.update_network_status(self.host, res, data={'up': round(upload, 1), 'down': round(download, 1)})
 
     def on_error(self, msg):
         self.context.update_network_status(self.host, msg, is_success=False)
@@ -0,0 +1,68 @@
+import random
+import time
+from collections import deque
+
+
+class PollScheduler():
+    '''Decides when each polling worker runs next.
+
+    - the first poll of each worker is delayed by a random offset, so hosts are not polled in bursts;
+    - every delay is jittered by +-`jitter` (a ratio);
+    - hosts with active GPU jobs are polled `active_factor` times the interval;
+    - hosts whose output did not change slow down by `idle_step` per poll, up to `idle_factor` times;
+    - failing hosts back off exponentially, up to `max_backoff` seconds.
+    '''
+
+    def __init__(self, jitter=0.2, active_factor=0.5, idle_factor=4, idle_step=1.5, max_backoff=300, min_delay=0.5):
+        self.jitter = jitter
+        self.active_factor = active_factor
+        self.idle_factor = idle_factor
+        self.idle_step = idle_step
+        self.max_backoff = max_backoff
+        self.min_delay = min_delay
+        self.factors = {}
+        self.polls = {}
+        self.workers = {}
+
+    def initial_delay(self, worker):
+        self.workers[worker.worker_name] = worker
+        self.factors[worker.worker_name] = 1.0
+        self.polls[worker.worker_name] = deque(maxlen=20)
+        return random.uniform(0, worker.poll_delay)
+
+    def next_delay(self, worker, consumed_time=0.0):
+        name = worker.worker_name
+        self.polls.setdefault(name, deque(maxlen=20)).append(time.time())
+        if worker.failures:
+            delay = min(self.max_backoff, worker.poll_delay * 2 ** (worker.failures - 1))
+            consumed_time = 0.0
+        elif worker.active:
+            delay = worker.poll_delay * self.active_factor
+            self.factors[name] = 1.0
+        elif not worker.changed:
+            self.factors[name] = min(self.idle_factor, self.factors.get(name, 1.0) * self.idle_step)
+            delay = worker.poll_delay * self.factors[name]
+        else:
+            self.factors[name] = 1.0
+            delay = worker.poll_delay
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(self.min_delay, delay - consumed_time)
+
+    def get_rate(self, name):
+        '''Polls per minute, over the last polls.'''
+        polls = self.polls.get(name)
+        if not polls or len(polls) < 2 or polls[-1] == polls[0]:
+            return None
+        return 60.0 * (len(polls) - 1) / (polls[-1] - polls[0])
+
+    def get_stats(self):
+        stats = {}
+        for name, worker in self.workers.items():
+            rate = self.get_rate(name)
+            stats[name] = {'rate_per_min': round(rate, 2) if rate else None,
+                           'nominal_per_min': round(60.0 / worker.poll_delay, 2),
+                           'failures': worker.failures,
+                           'active': worker.active,
+                           'changed': worker.changed,
+                           'idle_factor': round(self.factors.get(name, 1.0), 2)}
+        return stats
@@ -0,0 +1,48 @@
+class SectionParser():
+    '''Splits the output of a `Worker.set_cmd_line` command into its sections, in one pass.
+
+    The output can be fed in chunks as it streams in. `sections` holds the
+    sections received completely, i.e. up to their `<END k>` marker, so a
+    truncated output still yields the sections before the cut.
+    '''
+
+    def __init__(self, keys):
+        self.starts = {f'<START {k}>': k for k in keys}
+        self.sections = {}
+        self.current = None
+        self.end = None
+        self.lines = []
+        self.tail = ''
+
+    def feed(self, chunk):
+        lines = (self.tail + chunk).split('\n')
+        self.tail = lines.pop()
+        for line in lines:
+            self.feed_line(line)
+
+    def feed_line(self, line):
+        if self.current is None:
+            # anything outside of the markers is ignored
+            self.current = self.starts.get(line)
+            self.end = f'<END {self.current}>'
+            self.lines = []
+        elif line == self.end:
+            self.sections[self.current] = '\n'.join(self.lines)
+            self.current = None
+        else:
+            self.lines.append(line)
+
+    def close(self):
+        '''Flushes the last line. Returns the complete sections.'''
+        if self.tail:
+            self.feed_line(self.tail)
+            self.tail = ''
+        return self.sections
+
+    @property
+    def truncated(self):
+        '''The section started but not ended, if any.'''
+        return self.current
+
+    def missing(self):
+        return [k for k in self.starts.values() if k not in self.sections]
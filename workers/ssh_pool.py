@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import defaultdict
+
+import asyncssh
+
+from metrics import registry
+from utils import msg_from_host
+
+COMMAND_SECONDS = registry.histogram('gpustat_ssh_command_seconds', 'Duration of the remote commands, once running.',
+                                     ['host'])
+EVENTS = registry.counter('gpustat_ssh_events_total', 'SSH connects, reconnects, connect errors, run errors and timeouts.',
+                          ['host', 'event'])
+
+
+class SSHConnectionPool():
+    '''One SSH connection per (host, port), shared by all the remote workers.
+
+    Commands run on their own channels of the shared connection, at most
+    `max_channels` at a time per host (sshd's MaxSessions defaults to 10)
+    and at most `max_in_flight` at a time over all the hosts, so that hung
+    nodes cannot pile up stuck channels. A command only takes its slot once
+    the connection is up, so unreachable hosts do not hold any.
+    A broken connection is dropped and re-established on the next borrow,
+    with exponential backoff while the host keeps failing: within the
+    backoff, borrowing fails at once.
+    '''
+
+    def __init__(self, max_channels=8, max_in_flight=32, backoff_base=1, backoff_max=60, connect_timeout=10):
+        self.max_channels = max_channels
+        self.max_in_flight = max_in_flight
+        self.in_flight = None
+        self.waiting = 0
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.connect_timeout = connect_timeout
+        self.connections = {}
+        self.locks = defaultdict(asyncio.Lock)
+        self.channels = {}
+        self.failures = defaultdict(int)
+        self.next_attempt = defaultdict(float)
+        # borrowers waiting for a connection to be established, per host
+        self.connecting = defaultdict(int)
+        self.stats = defaultdict(lambda: defaultdict(int))
+
+    @staticmethod
+    def get_key(host, port):
+        # hostnames are case-insensitive, e.g. `db15` and `DB15` share one connection
+        return host.lower(), port
+
+    async def get(self, host, port=22, timeout=None):
+        '''Returns the connection to (host, port), connecting within `timeout` seconds if needed.'''
+        key = self.get_key(host, port)
+        conn = self.connections.get(key)
+        if conn is not None and not conn.is_closed():
+            return conn
+        self.connecting[key] += 1
+        try:
+            return await asyncio.wait_for(self.connect(host, port), timeout=timeout)
+        finally:
+            self.connecting[key] -= 1
+
+    async def connect(self, host, port):
+        key = self.get_key(host, port)
+        async with self.locks[key]:
+            conn = self.connections.get(key)
+            if conn is not None and not conn.is_closed():
+                return conn
+
+            wait = self.next_attempt[key] - time.time()
+            if wait > 0:
+                raise ConnectionError(f"{self.failures[key]} failed connects, next attempt in {wait:.1f} sec")
+            try:
+                conn = await asyncssh.connect(host, port=port, known_hosts=None, connect_timeout=self.connect_timeout)
+            except (Exception, asyncio.CancelledError):
+                # a cancel is the deadline of the borrower, see `get`
+                self.failures[key] += 1
+                self.stats[key]['connect_errors'] += 1
+                EVENTS.inc(host=key[0], event='connect_error')
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (self.failures[key] - 1))
+                self.next_attempt[key] = time.time() + delay
+                raise
+
+            if key in self.connections:
+                self.stats[key]['reconnects'] += 1
+                EVENTS.inc(host=key[0], event='reconnect')
+            self.stats[key]['connects'] += 1
+            EVENTS.inc(host=key[0], event='connect')
+            self.failures[key] = 0
+            self.connections[key] = conn
+            msg_from_host(f'{host}:{port}', "SSH connection established!", attrs=['bold'])
+            return conn
+
+    def discard(self, host, port, conn):
+        '''Drops a broken connection, so that the next borrower reconnects.'''
+        key = self.get_key(host, port)
+        if self.connections.get(key) is conn:
+            conn.close()
+
+    async def run(self, host, port, cmd, timeout=None, on_stdout=None):
+        '''Runs `cmd` on a new channel of the shared connection. `timeout` counts connecting and the run,
+        not the queueing for a channel.
+
+        With `on_stdout`, the output is passed to it chunk by chunk as it arrives, even if the run times out.
+        '''
+        key = self.get_key(host, port)
+        if self.in_flight is None:
+            self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        if key not in self.channels:
+            self.channels[key] = asyncio.Semaphore(self.max_channels)
+        start_time = time.time()
+        conn = await self.get(host, port, timeout=timeout)
+        if timeout is not None:
+            timeout = max(0.0, timeout - (time.time() - start_time))
+        self.waiting += 1
+        try:
+            await self.in_flight.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            async with self.channels[key]:
+                self.stats[key]['in_flight'] += 1
+                try:
+                    coro = conn.run(cmd) if on_stdout is None else self.run_streaming(conn, cmd, on_stdout)
+                    with COMMAND_SECONDS.time(host=key[0]):
+                        result = await asyncio.wait_for(coro, timeout=timeout)
+                except asyncio.TimeoutError:
+                    self.stats[key]['timeouts'] += 1
+                    EVENTS.inc(host=key[0], event='timeout')
+                    raise
+                except (asyncssh.misc.DisconnectError, asyncssh.misc.ChannelOpenError, OSError):
+                    self.stats[key]['run_errors'] += 1
+                    EVENTS.inc(host=key[0], event='run_error')
+                    self.discard(host, port, conn)
+                    raise
+                finally:
+                    self.stats[key]['in_flight'] -= 1
+                self.stats[key]['runs'] += 1
+                return result
+        finally:
+            self.in_flight.release()
+
+    @staticmethod
+    async def run_streaming(conn, cmd, on_stdout):
+        async with conn.create_process(cmd) as process:
+            while True:
+                chunk = await process.stdout.read(65536)
+                if not chunk:
+                    break
+                on_stdout(chunk)
+            return await process.wait()
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+
+    def get_stats(self):
+        stats = {'*': {'in_flight': sum(s['in_flight'] for s in self.stats.values()),
+                       'max_in_flight': self.max_in_flight,
+                       'waiting': self.waiting,
+                       'connecting': sum(self.connecting.values())}}
+        for key in sorted(set(self.connections) | set(self.stats)):
+            conn = self.connections.get(key)
+            stats[f'{key[0]}:{key[1]}'] = dict(self.stats[key],
+                                               connected=conn is not None and not conn.is_closed(),
+                                               connecting=self.connecting[key],
+                                               failures=self.failures[key])
+        return stats
+
+
+ssh_pool = SSHConnectionPool()
@@ -1,12 +1,29 @@
 import asyncio
 import asyncssh
+import hashlib
+import json
 import time
 from utils import msg_from_host, cprint
 import traceback
 
+from metrics import registry
+
+from .section_parser import SectionParser
+from .ssh_pool import ssh_pool as default_ssh_pool
+
+POLL_SECONDS = registry.histogram('gpustat_worker_poll_seconds', 'Duration of one poll: command(s) and processing.',
+                                  ['worker_type', 'host'])
+PROCESS_SECONDS = registry.histogram('gpustat_worker_process_seconds', 'Duration of parsing and processing one result.',
+                                     ['worker_type', 'host'])
+ERRORS = registry.counter('gpustat_worker_errors_total', 'Failed polls, including parse errors and timeouts.',
+                          ['worker_type', 'host'])
+PARTIAL = registry.counter('gpustat_worker_stale_sections_total', 'Commands that failed and fell back to their last result.',
+                           ['worker_type', 'host'])
+
 
 class Worker():
-    def __init__(self, context, worker_type, host='localhost', poll_delay=8, timeout=60):
+    def __init__(self, context, worker_type, host='localhost', poll_delay=8, timeout=60, ssh_pool=None,
+                 scheduler=None):
         assert worker_type.startswith('remote') or worker_type.startswith('local') \
             or worker_type.startswith('function')
         self.context = context
@@ -15,6 +32,22 @@ class Worker():
         self.worker_name = f"{host}-{worker_type}"
         self.poll_delay = poll_delay
         self.timeout = timeout
+        self.ssh_pool = ssh_pool or default_ssh_pool
+        self.stream_cmd = None
+        self.cmd_timeouts = None
+        self.cmd_intervals = None
+        # the last result of each command, reused while the command fails or is not due
+        self.last_results = {}
+        self.result_times = {}
+        self.stale_keys = set()
+        # key -> (digest of the output, parsed result), see `parse_section`
+        self.parsed_sections = {}
+
+        # read by the scheduler, if any, to adapt the polling rate
+        self.scheduler = scheduler
+        self.failures = 0
+        self.active = False
+        self.changed = True
 
     def process_result_dict(self, result_dict):
         '''Given the result dict, process it and write to `self.context`.'''
@@ -24,24 +57,112 @@ class Worker():
         '''When error occurs, write it to `self.context`. '''
         pass
 
+    def _process(self, result_dict):
+        with PROCESS_SECONDS.time(worker_type=self.worker_type, host=self.host):
+            self.process_result_dict(result_dict)
+        self.failures = 0
+
+    def _fail(self, msg):
+        self.failures += 1
+        ERRORS.inc(worker_type=self.worker_type, host=self.host)
+        self.on_error(msg)
+
+    def next_delay(self, consumed_time=0.0):
+        '''Seconds to wait before the next poll.'''
+        if self.scheduler is None:
+            return max(0.05, self.poll_delay - consumed_time) if consumed_time else self.poll_delay
+        return self.scheduler.next_delay(self, consumed_time)
+
     def set_worker_function(self, func):
         '''Worker function should return a dict to be fed into `self.process_result_dict`. '''
         self.worker_function = func
 
-    def set_cmd_line(self, cmd_dict):
+    def set_cmd_line(self, cmd_dict, timeouts=None, intervals=None):
+        '''With `timeouts` ({key: seconds}), remote commands run on their own channels with their own deadlines.
+
+        With `intervals` ({key: seconds}), slow-changing remote commands only run that often,
+        their last result is reused in between.
+        '''
         self.cmd_dict = cmd_dict
-        self.cmd = ' && '.join([f"echo '<START {k}>' && {v} && echo '<END {k}>'"
-                                for k, v in cmd_dict.items()])
+        self.cmd_timeouts = timeouts
+        self.cmd_intervals = intervals
+        self.cmd = self.build_cmd(cmd_dict)
         return self.cmd
 
-    def get_result_dict(self, raw_result):
-        lines = raw_result.split('\n')
-        res = {}
-        for k in self.cmd_dict.keys():
-            idx1 = lines.index(f'<START {k}>')
-            idx2 = lines.index(f'<END {k}>')
-            res[k] = '\n'.join(lines[idx1 + 1: idx2])
-        return res
+    def build_cmd(self, keys):
+        return ' && '.join([f"echo '<START {k}>' && {self.cmd_dict[k]} && echo '<END {k}>'" for k in keys])
+
+    def due_keys(self):
+        '''The commands to run this poll.'''
+        if not self.cmd_intervals:
+            return list(self.cmd_dict)
+        now = time.time()
+        return [k for k in self.cmd_dict
+                if k not in self.result_times or now - self.result_times[k] >= self.cmd_intervals.get(k, 0)]
+
+    def get_cmd(self, keys):
+        return self.cmd if len(keys) == len(self.cmd_dict) else self.build_cmd(keys)
+
+    def parse_section(self, key, text, parse, normalize=None):
+        '''Returns (`parse(text)`, changed). The parsed result is reused while the output of `key` is unchanged.
+
+        `normalize(text)` drops what changes on every poll without mattering, e.g. a query time.
+        '''
+        digest = hashlib.blake2b((normalize(text) if normalize else text).encode(), digest_size=16).digest()
+        cached = self.parsed_sections.get(key)
+        if cached is not None and cached[0] == digest:
+            return cached[1], False
+        result = parse(text)
+        self.parsed_sections[key] = (digest, result)
+        return result, True
+
+    def set_stream_cmd(self, cmd):
+        '''A long-lived remote command printing one json result dict per line, used instead of polling.'''
+        self.stream_cmd = cmd
+        return self.stream_cmd
+
+    def merge_results(self, result_dict, errors):
+        '''Completes `result_dict` with the last results of the failed commands, listed in `self.stale_keys`.
+
+        `errors` is {key: reason} of the failed commands. Raises if a command never succeeded,
+        or if every command failed this time: the host is then down, not partially stale.
+        '''
+        if errors and not result_dict:
+            raise RuntimeError('; '.join(f"{k}: {v}" for k, v in errors.items()))
+        self.last_results.update(result_dict)
+        now = time.time()
+        self.result_times.update((k, now) for k in result_dict)
+        missing = [k for k in self.cmd_dict if k not in self.last_results]
+        if missing:
+            raise RuntimeError('; '.join(f"{k}: {errors.get(k, 'no output')}" for k in missing))
+        if errors:
+            PARTIAL.inc(len(errors), worker_type=self.worker_type, host=self.host)
+            msg_from_host(self.worker_name, "Partial result, " + '; '.join(f"{k}: {v}" for k, v in errors.items()),
+                          color='yellow')
+        self.stale_keys = set(errors)
+        return {k: self.last_results[k] for k in self.cmd_dict}
+
+    def get_section_errors(self, parser, reason):
+        '''{key: reason} of the sections missing from `parser`.'''
+        return {k: 'truncated, ' + reason if k == parser.truncated else reason for k in parser.missing()}
+
+    async def _run_remote_split(self, host, port):
+        '''Runs each due command of `cmd_dict` concurrently, each with its own deadline.'''
+        keys = self.due_keys()
+        results = await asyncio.gather(*[self.ssh_pool.run(host, port, self.cmd_dict[k],
+                                                           timeout=self.cmd_timeouts.get(k, self.timeout))
+                                         for k in keys], return_exceptions=True)
+        result_dict, errors = {}, {}
+        for k, result in zip(keys, results):
+            if isinstance(result, asyncio.TimeoutError):
+                errors[k] = f"timeout after {self.cmd_timeouts.get(k, self.timeout)} sec"
+            elif isinstance(result, BaseException):
+                errors[k] = f"{type(result).__name__}: {result}"
+            elif result.exit_status != 0:
+                errors[k] = f"exitcode={result.exit_status}"
+            else:
+                result_dict[k] = result.stdout.rstrip('\n')
+        return self.merge_results(result_dict, errors)
 
     async def _loop_body_local(self, cmd, verbose=False):
         while True:
@@ -51,50 +172,89 @@ class Worker():
             proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE,
                                                          stderr=asyncio.subprocess.PIPE)
             stdout, stderr = await proc.communicate()
-            if proc.returncode != 0 and stderr:
-                msg = msg_from_host(self.worker_name, f"Error, exitcode={proc.returncode}, stderr={stderr.decode()}", color='red')
-                self.on_error(msg)
-            else:
-                try:
-                    if verbose:
-                        msg_from_host(self.worker_name, f"OK from {self.worker_type}, ({len(stdout.decode())} bytes)", color='cyan')
-                    raw_result = stdout.decode()
-                    result_dict = self.get_result_dict(raw_result)
-                    self.process_result_dict(result_dict)
-
-                except Exception as ex:
-                    msg = msg_from_host(self.worker_name, f"{type(ex).__name__}: {ex}", color='red')
-                    self.on_error(msg)
+            try:
+                if verbose:
+                    msg_from_host(self.worker_name, f"OK from {self.worker_type}, ({len(stdout)} bytes)", color='cyan')
+                parser = SectionParser(self.cmd_dict)
+                parser.feed(stdout.decode())
+                parser.close()
+                reason = f"exitcode={proc.returncode}, stderr={stderr.decode().strip()}"
+                result_dict = self.merge_results(parser.sections, self.get_section_errors(parser, reason))
+                self._process(result_dict)
+            except Exception as ex:
+                msg = msg_from_host(self.worker_name, f"{type(ex).__name__}: {ex}", color='red')
+                self._fail(msg)
 
             # wait for a while...
             consumed_time = time.time() - start_time
-            await asyncio.sleep(max(0.05, self.poll_delay - consumed_time))
+            POLL_SECONDS.observe(consumed_time, worker_type=self.worker_type, host=self.host)
+            await asyncio.sleep(self.next_delay(consumed_time))
 
     async def _loop_body_remote(self, cmd, host, port, verbose=False):
-        async with asyncssh.connect(host, port=port, known_hosts=None) as conn:
-            msg_from_host(self.worker_name, "SSH connection established!", attrs=['bold'])
+        # the connection is borrowed from the pool, shared with other workers of the same host
+        while True:
+            start_time = time.time()
+            # the sections are parsed as the output streams in, the complete ones survive a timeout
+            keys = self.due_keys()
+            parser = SectionParser(keys)
+            try:
+                result = await self.ssh_pool.run(host, port, self.get_cmd(keys), timeout=self.timeout,
+                                                 on_stdout=parser.feed)
+                reason = f"exitcode={result.exit_status}"
+            except asyncio.TimeoutError:
+                reason = f"timeout after {self.timeout} sec"
+            parser.close()
+            try:
+                if verbose:
+                    msg_from_host(self.worker_name, f"OK ({len(parser.sections)} sections)", color='cyan')
+                result_dict = self.merge_results(parser.sections, self.get_section_errors(parser, reason))
+                self._process(result_dict)
+            except Exception as ex:
+                msg = msg_from_host(self.worker_name, f"{type(ex).__name__}: {ex}", color='red')
+                self._fail(msg)
 
-            while True:
-                start_time = time.time()
-                result = await asyncio.wait_for(conn.run(cmd), timeout=self.timeout)
+            # wait for a while...
+            consumed_time = time.time() - start_time
+            POLL_SECONDS.observe(consumed_time, worker_type=self.worker_type, host=self.host)
+            await asyncio.sleep(self.next_delay(consumed_time))
 
-                if result.exit_status != 0:
-                    msg = msg_from_host(self.worker_name, f"Remote command error, exitcode={result.exit_status}", color='red')
-                    self.on_error(msg)
-                else:
-                    try:
-                        if verbose:
-                            msg_from_host(self.worker_name, f"OK ({len(result.stdout)} bytes)", color='cyan')
-                        raw_results = result.stdout
-                        result_dict = self.get_result_dict(raw_results)
-                        self.process_result_dict(result_dict)
-                    except Exception as ex:
-                        msg = msg_from_host(self.worker_name, f"{type(ex).__name__}: {ex}", color='red')
-                        self.on_error(msg)
-
-                # wait for a while...
-                consumed_time = time.time() - start_time
-                await asyncio.sleep(max(0.05, self.poll_delay - consumed_time))
+    async def _loop_body_remote_split(self, host, port, verbose=False):
+        while True:
+            start_time = time.time()
+            try:
+                result_dict = await self._run_remote_split(host, port)
+                if verbose:
+                    msg_from_host(self.worker_name, f"OK ({sum(map(len, result_dict.values()))} bytes)", color='cyan')
+                self._process(result_dict)
+            except Exception as ex:
+                msg = msg_from_host(self.worker_name, f"{type(ex).__name__}: {ex}", color='red')
+                self._fail(msg)
+
+            # wait for a while...
+            consumed_time = time.time() - start_time
+            POLL_SECONDS.observe(consumed_time, worker_type=self.worker_type, host=self.host)
+            await asyncio.sleep(self.next_delay(consumed_time))
+
+    async def _loop_body_stream(self, cmd, host, port, verbose=False):
+        conn = await self.ssh_pool.get(host, port)
+        async with conn.create_process(cmd) as process:
+            msg_from_host(self.worker_name, "Streaming agent started!", attrs=['bold'])
+
+            while True:
+                line = await asyncio.wait_for(process.stdout.readline(), timeout=self.timeout)
+                if not line:
+                    stderr = await process.stderr.read()
+                    msg = msg_from_host(self.worker_name, f"Agent exited, exitcode={process.exit_status}, stderr={stderr}", color='red')
+                    self._fail(msg)
+                    return
+                try:
+                    if verbose:
+                        msg_from_host(self.worker_name, f"OK ({len(line)} bytes)", color='cyan')
+                    result_dict = json.loads(line)
+                    self._process(result_dict)
+                except Exception as ex:
+                    msg = msg_from_host(self.worker_name, f"{type(ex).__name__}: {ex}", color='red')
+                    self._fail(msg)
 
     async def _loop_body_function(self, verbose=False):
         while True:
@@ -104,20 +264,28 @@ class Worker():
             start_time = time.time()
             try:
                 result_dict = await self.worker_function()
-                self.process_result_dict(result_dict)
+                self._process(result_dict)
             except Exception as ex:
                 msg = msg_from_host(self.worker_name, f"{type(ex).__name__}: {ex}", color='red')
-                self.on_error(msg)
+                self._fail(msg)
                 # cprint(traceback.format_exc())
             consumed_time = time.time() - start_time
+            POLL_SECONDS.observe(consumed_time, worker_type=self.worker_type, host=self.host)
             # print('consumed:', consumed_time)
-            await asyncio.sleep(max(0.05, self.poll_delay - consumed_time))
+            await asyncio.sleep(self.next_delay(consumed_time))
 
     async def run(self):
+        if self.scheduler is not None:
+            # spread the first polls of all the workers
+            await asyncio.sleep(self.scheduler.initial_delay(self))
         while True:
             try:
                 if self.worker_type.startswith('local'):
                     await self._loop_body_local(self.cmd)
+                elif self.worker_type.startswith('remote') and self.stream_cmd:
+                    await self._loop_body_stream(self.stream_cmd, self.host, self.port)
+                elif self.worker_type.startswith('remote') and self.cmd_timeouts is not None:
+                    await self._loop_body_remote_split(self.host, self.port)
                 elif self.worker_type.startswith('remote'):
                     await self._loop_body_remote(self.cmd, self.host, self.port)
                 elif self.worker_type.startswith('function'):
@@ -130,19 +298,20 @@ class Worker():
             except (asyncio.TimeoutError):
                 # Timeout Error
                 msg = msg_from_host(self.worker_name, f"Timeout after {self.timeout} sec.", color='red')
-                self.on_error(msg)
+                self._fail(msg)
             except (asyncssh.misc.DisconnectError, asyncssh.misc.ChannelOpenError, OSError) as ex:
                 # error or disconnected (retry)
                 msg = msg_from_host(self.worker_name, f"Disconnected:, {str(ex)}", color='red')
-                self.on_error(msg)
+                self._fail(msg)
             except Exception as ex:
                 # A general exception unhandled, throw
                 msg = msg_from_host(self.worker_name, f"{self.worker_type} - {type(ex).__name__}: {ex}", color='red')
-                self.on_error(msg)
+                self._fail(msg)
                 cprint(traceback.format_exc())
                 raise
 
-            # retry upon timeout/disconnected, etc.
-            msg = msg_from_host(self.worker_name, f"Disconnected, retrying in {self.poll_delay} sec...", color='yellow')
+            # retry upon timeout/disconnected, etc., backing off with the scheduler
+            delay = self.next_delay()
+            msg = msg_from_host(self.worker_name, f"Disconnected, retrying in {delay:.1f} sec...", color='yellow')
             # self.on_error(msg)
-            await asyncio.sleep(self.poll_delay)
+            await asyncio.sleep(delay)